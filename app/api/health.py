@@ -0,0 +1,22 @@
+import os
+
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+import globals
+from app.core.metrics import process_memory
+
+router = APIRouter()
+
+
+@router.get("/health", include_in_schema=False)
+async def health():
+    """Liveness: the server is up, whether or not the model has loaded. Also reports this worker's memory."""
+    return {"status": "ok", "model": globals.model_loader.state, "pid": os.getpid(), "memory": process_memory()}
+
+
+@router.get("/ready", include_in_schema=False)
+async def ready():
+    """Readiness: 200 once the model is loaded and warm, 503 with loading progress until then."""
+    status = globals.model_loader.status()
+    return JSONResponse(status, status_code=200 if globals.model_loader.ready else 503)
@@ -1,56 +1,100 @@
-from typing import Dict, Any, Optional
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
 from fastapi.responses import StreamingResponse
 import logging
 from app.api.v1.models.chat_completions import ChatCompletionsRequest
-import json
+from app.core import tracing
+from app.core.executor import QueueFullError
+from app.core.image_decode import ImageDecodeError
+from app.core.image_fetch import ImageFetchError
+from app.core.sse import DONE, ChatCompletionChunkEncoder, coalesce
+import os
 import time
+import uuid
 
 logger = logging.getLogger()
 router = APIRouter()
 
 import globals
 
-def format_openai_chunk(text: str, role: str = "assistant", finish_reason: Optional[str] = None, force_zhtw: bool = False) -> Dict[str, Any]:
+MODEL_NAME = "minicpm-v"
+# Coalescing window for streamed text: fragments arriving within this many
+# milliseconds go out as one event, flushed early at SSE_COALESCE_BYTES.
+SSE_COALESCE_MS = float(os.getenv("SSE_COALESCE_MS", "0"))
+SSE_COALESCE_BYTES = int(os.getenv("SSE_COALESCE_BYTES", "0"))
 
-    if force_zhtw:
-        opencc_converter = globals.opencc_converter
-        text = opencc_converter.convert(text)
+async def sse_format(channel, force_zhtw: bool = False, include_usage: bool = False):
+    encoder = ChatCompletionChunkEncoder(f"chatcmpl-{uuid.uuid4().hex}", MODEL_NAME, int(time.time()))
+    # One converter per stream so phrases split across chunks are still converted as a whole
+    converter = globals.opencc_converter.stream() if force_zhtw else None
+    try:
+        async for text in coalesce(channel, SSE_COALESCE_MS, SSE_COALESCE_BYTES):
+            with tracing.span("sse.encode"):
+                if converter is not None:
+                    text = converter.feed(text)
+                data = encoder.chunk(text) if text else None
+            if data:
+                # The generator resumes once the server has written the event
+                with tracing.span("sse.write"):
+                    yield data
+    except ImageDecodeError as e:
+        # The status line is already sent, so the error goes out as an event
+        yield encoder.error(str(e), "invalid_request_error", 400)
+        yield DONE
+        return
+    except Exception:
+        # Logged by the inference worker
+        yield encoder.error("Inference failed", "server_error", 500)
+        yield DONE
+        return
+    finally:
+        # If the client disconnected mid-stream, the backend stops decoding at
+        # its next token and a batched sequence leaves the batch
+        channel.cancel()
 
-    return {
-        "choices": [
-            {
-                "delta": {"role": role, "content": text},
-                "index": 0,
-                "finish_reason": finish_reason
-            }
-        ]
-    }
+    if converter is not None:
+        text = converter.flush()
+        if text:
+            yield encoder.chunk(text)
 
-def sse_format(generator, force_zhtw: bool = False):
-    for text in generator:
-        chunk = format_openai_chunk(text, force_zhtw=force_zhtw)
-        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-    
-    end_chunk = format_openai_chunk("", finish_reason="stop")
-    yield f"data: {json.dumps(end_chunk, ensure_ascii=False)}\n\n"
+    yield encoder.finish("stop")
+    if include_usage:
+        yield encoder.usage(channel.usage.to_dict())
 
 @router.post("/chat/completions")
-async def chat_completions(request: ChatCompletionsRequest):        
-    answer = globals.chat_model.chat(request)
+async def chat_completions(request: ChatCompletionsRequest):
+    tracing.mark_handler_start()
+    executor = globals.inference_executor
+    if executor is None:
+        raise HTTPException(status_code=503, detail="Model is loading", headers={"Retry-After": "5"})
+    # Remote images download on the event loop while the request waits for a
+    # worker; only once it is admitted, so a rejected request downloads nothing
+    prefetch = globals.image_fetcher.prefetch
 
     if (request.stream):
-        return StreamingResponse(sse_format(answer, request.force_zhtw), media_type="text/event-stream")
+        try:
+            channel = executor.stream(request, on_admit=prefetch)
+        except QueueFullError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except ImageFetchError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        include_usage = request.stream_options is not None and request.stream_options.include_usage
+        return StreamingResponse(sse_format(channel, request.force_zhtw, include_usage), media_type="text/event-stream")
     else:
+        try:
+            answer, usage = await executor.submit(request, on_admit=prefetch)
+        except QueueFullError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except ImageDecodeError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         # Non-streaming mode: Convert the string answer to the OpenAI format
-        completion_tokens = len(globals.chat_model.model.tokenizer.encode(answer))
         if request.force_zhtw:
-            answer = globals.opencc_converter.convert(answer)
+            with tracing.span("zhtw"):
+                answer = globals.opencc_converter.convert(answer)
         formatted_answer = {
             "id": "example-id",  # You can generate a unique ID here
             "object": "chat.completion",
             "created": int(time.time()),
-            "model": "minicpm-v",
+            "model": MODEL_NAME,
             "choices": [
                 {
                     "message": {
@@ -61,11 +105,7 @@ async def chat_completions(request: ChatCompletionsRequest):
                     "finish_reason": "stop"
                 }
             ],
-            "usage": {
-                "prompt_tokens": 0,
-                "completion_tokens": completion_tokens,
-                "total_tokens": completion_tokens
-            }
+            "usage": usage.to_dict()
         }
         return formatted_answer
 
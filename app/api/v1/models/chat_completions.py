@@ -1,11 +1,14 @@
-from typing import Any, List, Literal, Text, Optional, Union
+from typing import Any, Dict, List, Literal, Text, Optional, Union
 from click import Option
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
 class ChatMessage(BaseModel):
     role: Literal["user", "assistant", "system"]
     content: Union[Text, List[Any]]
 
+class StreamOptions(BaseModel):
+    include_usage: bool = False
+
 class ChatCompletionsRequest(BaseModel):
     messages: List[ChatMessage]
     temperature: Optional[float] = 1.0
@@ -13,8 +16,18 @@ class ChatCompletionsRequest(BaseModel):
     top_k: Optional[int] = 100
     max_tokens: Optional[int] = 2048
     stream: Optional[bool] = False
-    stop: Optional[List[str]] = None
+    stream_options: Optional[StreamOptions] = None
+    stop: Optional[Union[str, List[str]]] = None
     repetition_penalty: Optional[float] = 1.05
     force_zhtw: bool = False
 
-    
\ No newline at end of file
+    
+    _remote_images: Dict[str, Any] = PrivateAttr(default_factory=dict)
+
+    def add_remote_image(self, url, future):
+        self._remote_images[url] = future
+
+    def remote_image(self, url):
+        """Bytes of an http(s) image_url, waiting for its download if needed (None if it was never started)."""
+        future = self._remote_images.get(url)
+        return future.result() if future is not None else None
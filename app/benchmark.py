@@ -0,0 +1,328 @@
+"""
+Load generator for `/v1/chat/completions`.
+
+    python -m app.benchmark --url http://localhost:5000 --requests 200 --concurrency 8
+    python -m app.benchmark --rate 4 --duration 60 --image-size 448x448 --stream-ratio 0.5
+
+Without `--rate` it runs a closed loop: `--concurrency` clients each send
+their next request as soon as the previous one finishes. With `--rate` it
+runs an open loop: requests arrive as a Poisson process at that many per
+second regardless of how fast the server answers, so queueing shows up in
+the latencies. Only standard HTTP is used, so it runs just as well against
+a server with the stub backend on a CPU-only machine.
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import random
+import sys
+import time
+
+import httpx
+from PIL import Image
+
+FILLER = ("The quick brown fox jumps over the lazy dog while the committee reviews "
+          "the quarterly report and the weather stays mild. ")
+
+
+def percentile(values, q):
+    """Linearly interpolated percentile (`q` in 0..100) of unsorted values."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def summarize(values):
+    if not values:
+        return None
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+
+
+def parse_size(text):
+    """`448x448` -> (448, 448); `0` means a text-only request."""
+    if text in ("0", "none"):
+        return None
+    width, _, height = text.partition("x")
+    return int(width), int(height or width)
+
+
+def make_image(size, rng, quality=90):
+    """A noisy JPEG data URL; noise keeps the encoded size close to a real photo's."""
+    width, height = size
+    small = (max(width // 8, 1), max(height // 8, 1))
+    noise = Image.frombytes("RGB", small, rng.randbytes(small[0] * small[1] * 3))
+    image = noise.resize((width, height), Image.BILINEAR)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+class Workload:
+    """Builds request bodies from the command line options with a seeded RNG."""
+
+    def __init__(self, args):
+        self.rng = random.Random(args.seed)
+        self.args = args
+        self.sizes = [parse_size(s) for s in args.image_size]
+        # Images are encoded once per size; --unique-images re-encodes per request to defeat the caches
+        self._images = {size: make_image(size, self.rng) for size in self.sizes if size is not None}
+
+    def request(self, index):
+        args = self.args
+        stream = self.rng.random() < args.stream_ratio
+        size = self.rng.choice(self.sizes)
+        messages = []
+        if args.system_prompt:
+            messages.append({"role": "system", "content": args.system_prompt})
+        for turn in range(args.turns - 1):
+            messages.append({"role": "user", "content": f"Question {turn}: " + FILLER * args.prompt_repeat})
+            messages.append({"role": "assistant", "content": f"Answer {turn}: " + FILLER})
+        question = f"Request {index}: describe this in detail. " + FILLER * args.prompt_repeat
+        if size is None:
+            messages.append({"role": "user", "content": question})
+        else:
+            image = make_image(size, self.rng) if args.unique_images else self._images[size]
+            messages.append({"role": "user", "content": [
+                {"type": "text", "text": question},
+                {"type": "image_url", "image_url": {"url": image}},
+            ]})
+        body = {
+            "messages": messages,
+            "max_tokens": args.max_tokens,
+            "temperature": args.temperature,
+            "stream": stream,
+        }
+        if stream:
+            body["stream_options"] = {"include_usage": True}
+        return body
+
+
+class Result:
+    __slots__ = ("stream", "image", "ok", "error", "start", "end", "first_token_at",
+                 "inter_token", "prompt_tokens", "completion_tokens")
+
+    def __init__(self, stream, image):
+        self.stream = stream
+        self.image = image
+        self.ok = False
+        self.error = None
+        self.start = time.perf_counter()
+        self.end = None
+        self.first_token_at = None
+        self.inter_token = []
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    @property
+    def latency(self):
+        return self.end - self.start
+
+    @property
+    def ttft(self):
+        return self.first_token_at - self.start if self.first_token_at is not None else None
+
+    @property
+    def tokens_per_second(self):
+        if self.first_token_at is None or self.completion_tokens < 2:
+            return None
+        decode_time = self.end - self.first_token_at
+        return (self.completion_tokens - 1) / decode_time if decode_time > 0 else None
+
+
+class _HTTPStatus(Exception):
+    def __init__(self, status_code):
+        super().__init__(status_code)
+        self.status_code = status_code
+
+
+async def send(client, url, body):
+    result = Result(body["stream"], isinstance(body["messages"][-1]["content"], list))
+    try:
+        if body["stream"]:
+            await _send_stream(client, url, body, result)
+        else:
+            response = await client.post(url, json=body)
+            if response.status_code != 200:
+                raise _HTTPStatus(response.status_code)
+            data = response.json()
+            result.first_token_at = time.perf_counter()
+            usage = data.get("usage") or {}
+            result.prompt_tokens = usage.get("prompt_tokens", 0)
+            result.completion_tokens = usage.get("completion_tokens", 0)
+        result.ok = True
+    except _HTTPStatus as e:
+        result.error = f"http_{e.status_code}"
+    except httpx.TimeoutException:
+        result.error = "timeout"
+    except (httpx.HTTPError, ValueError) as e:
+        result.error = type(e).__name__
+    result.end = time.perf_counter()
+    return result
+
+
+async def _send_stream(client, url, body, result):
+    last = None
+    async with client.stream("POST", url, json=body) as response:
+        if response.status_code != 200:
+            raise _HTTPStatus(response.status_code)
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            payload = line[6:]
+            if payload == "[DONE]":
+                break
+            chunk = json.loads(payload)
+            if chunk.get("usage"):
+                result.prompt_tokens = chunk["usage"].get("prompt_tokens", 0)
+                result.completion_tokens = chunk["usage"].get("completion_tokens", 0)
+            for choice in chunk.get("choices", []):
+                if choice.get("delta", {}).get("content"):
+                    now = time.perf_counter()
+                    if last is None:
+                        result.first_token_at = now
+                    else:
+                        result.inter_token.append(now - last)
+                    last = now
+
+
+async def run_closed(client, url, workload, total, concurrency, deadline):
+    results = []
+    counter = iter(range(total))
+
+    async def client_loop():
+        for index in counter:
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            results.append(await send(client, url, workload.request(index)))
+
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    return results
+
+
+async def run_open(client, url, workload, total, rate, deadline, rng):
+    tasks = []
+    next_at = time.perf_counter()
+    for index in range(total):
+        next_at += rng.expovariate(rate)
+        if deadline is not None and next_at >= deadline:
+            break
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(send(client, url, workload.request(index))))
+    return list(await asyncio.gather(*tasks))
+
+
+def report(results, elapsed, args):
+    def section(selected):
+        ok = [r for r in selected if r.ok]
+        errors = {}
+        for r in selected:
+            if not r.ok:
+                errors[r.error] = errors.get(r.error, 0) + 1
+        completion_tokens = sum(r.completion_tokens for r in ok)
+        return {
+            "requests": len(selected),
+            "succeeded": len(ok),
+            "error_rate": (len(selected) - len(ok)) / len(selected) if selected else 0.0,
+            "errors": errors,
+            "latency_s": summarize([r.latency for r in ok]),
+            "ttft_s": summarize([r.ttft for r in ok if r.ttft is not None]),
+            "inter_token_s": summarize([gap for r in ok for gap in r.inter_token]),
+            "tokens_per_second": summarize([r.tokens_per_second for r in ok if r.tokens_per_second is not None]),
+            "prompt_tokens": sum(r.prompt_tokens for r in ok),
+            "completion_tokens": completion_tokens,
+            "throughput_rps": len(ok) / elapsed if elapsed > 0 else None,
+            "throughput_tokens_per_second": completion_tokens / elapsed if elapsed > 0 else None,
+        }
+
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "elapsed_s": elapsed,
+        "overall": section(results),
+        "stream": section([r for r in results if r.stream]),
+        "non_stream": section([r for r in results if not r.stream]),
+        "with_image": section([r for r in results if r.image]),
+        "text_only": section([r for r in results if not r.image]),
+    }
+
+
+def _ms(stats, key):
+    return f"{stats[key] * 1000:.1f}" if stats else "-"
+
+
+def print_summary(summary):
+    overall = summary["overall"]
+    print(f"{overall['succeeded']}/{overall['requests']} ok in {summary['elapsed_s']:.1f}s, "
+          f"{overall['throughput_rps']:.2f} req/s, {overall['throughput_tokens_per_second']:.1f} tokens/s, "
+          f"error rate {overall['error_rate']:.1%} {overall['errors'] or ''}")
+    print(f"{'':12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, key in (("latency", "latency_s"), ("ttft", "ttft_s"), ("inter-token", "inter_token_s")):
+        stats = overall[key]
+        print(f"{name:12}{_ms(stats, 'p50'):>10}{_ms(stats, 'p95'):>10}{_ms(stats, 'p99'):>10}")
+
+
+async def main(args):
+    url = args.url.rstrip("/") + "/v1/chat/completions"
+    workload = Workload(args)
+    total = args.requests if args.requests > 0 else sys.maxsize
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        for index in range(args.warmup):
+            await send(client, url, workload.request(-1 - index))
+        start = time.perf_counter()
+        deadline = start + args.duration if args.duration else None
+        if args.rate:
+            results = await run_open(client, url, workload, total, args.rate, deadline, workload.rng)
+        else:
+            results = await run_closed(client, url, workload, total, args.concurrency, deadline)
+        elapsed = time.perf_counter() - start
+
+    summary = report(results, elapsed, args)
+    print_summary(summary)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test /v1/chat/completions.")
+    parser.add_argument("--url", default="http://localhost:5000", help="server base URL (include ROOT_PATH)")
+    parser.add_argument("--requests", type=int, default=100, help="number of requests, 0 for no limit")
+    parser.add_argument("--duration", type=float, default=0, help="stop sending after this many seconds")
+    parser.add_argument("--concurrency", type=int, default=4, help="clients in the closed loop")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="Poisson arrival rate in requests/s (open loop); 0 for a closed loop")
+    parser.add_argument("--image-size", nargs="+", default=["448x448"],
+                        help="image sizes to pick from per request, WxH, or 0 for text only")
+    parser.add_argument("--unique-images", action="store_true",
+                        help="a new image for every request, so image caches always miss")
+    parser.add_argument("--turns", type=int, default=1, help="conversation depth in user turns")
+    parser.add_argument("--prompt-repeat", type=int, default=1, help="filler sentences per user turn")
+    parser.add_argument("--system-prompt", default="")
+    parser.add_argument("--stream-ratio", type=float, default=1.0, help="fraction of streamed requests")
+    parser.add_argument("--max-tokens", type=int, default=128)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--warmup", type=int, default=1, help="requests sent before measuring")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
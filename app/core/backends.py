@@ -0,0 +1,145 @@
+import importlib
+import inspect
+import logging
+import threading
+import time
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class BackendSpec:
+    __slots__ = ("name", "factory", "match")
+
+    def __init__(self, name, factory, match=None):
+        self.name = name
+        self.factory = factory
+        self.match = match
+
+
+_backends = []
+
+
+def register_backend(name, factory, match=None):
+    """
+    Register `factory(model_path, **options)` under `name`. Model ids equal to
+    `name`, or for which `match(model_id)` is true, are served by it; earlier
+    registrations win. `factory` may be a `"module:attribute"` string, imported
+    only when the backend is created.
+    """
+    _backends.append(BackendSpec(name, factory, match))
+
+
+def resolve_backend(model_id, backend=None):
+    """The backend named `backend`, or else the first one that claims `model_id`."""
+    if backend:
+        for spec in _backends:
+            if spec.name == backend:
+                return spec
+        raise ValueError(f"Unknown backend {backend!r}; registered: {', '.join(s.name for s in _backends)}")
+    for spec in _backends:
+        if spec.name == model_id:
+            return spec
+    for spec in _backends:
+        if spec.match is not None and spec.match(model_id):
+            return spec
+    raise ValueError(f"No backend for model {model_id!r}; registered: {', '.join(s.name for s in _backends)}")
+
+
+def backend_names():
+    return [spec.name for spec in _backends]
+
+
+def create_backend(model_id, backend=None, **options):
+    """
+    Build the backend for `model_id`. Options the backend's factory does not
+    accept, and options left as None, are dropped so it uses its own default.
+    A factory taking `**kwargs` gets every option that is set.
+    """
+    spec = resolve_backend(model_id, backend)
+    factory = spec.factory
+    if isinstance(factory, str):
+        module, _, attribute = factory.partition(":")
+        factory = getattr(importlib.import_module(module), attribute)
+    accepted = inspect.signature(factory).parameters
+    takes_any = any(p.kind is inspect.Parameter.VAR_KEYWORD for p in accepted.values())
+    kwargs = {k: v for k, v in options.items() if v is not None and (takes_any or k in accepted)}
+    logger.info(f"Creating backend {spec.name} for {model_id} with {sorted(kwargs)}")
+    return spec.name, factory(model_id, **kwargs)
+
+
+def parse_dtype(name):
+    """`"bfloat16"` / `"bf16"` / `"float16"` ... -> torch dtype; empty means the backend's default."""
+    if not name:
+        return None
+    aliases = {"bf16": "bfloat16", "fp16": "float16", "half": "float16", "fp32": "float32", "float": "float32"}
+    dtype = getattr(torch, aliases.get(name, name), None)
+    if not isinstance(dtype, torch.dtype):
+        raise ValueError(f"Unknown dtype {name!r}")
+    return dtype
+
+
+class ModelLoader:
+    """
+    Builds the model on a background thread so the server binds its port and
+    answers health checks while weights load.
+
+    `build(loader)` does the work and reports progress with
+    `loader.phase(name)`; the loader is ready once it returns.
+    """
+
+    def __init__(self, build):
+        self._build = build
+        self._thread = None
+        self._ready = threading.Event()
+        self.state = "starting"
+        self.error = None
+        self.started_at = time.monotonic()
+        self._phases = []
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="model-loader", daemon=True)
+        self._thread.start()
+
+    def phase(self, name):
+        now = time.monotonic()
+        self._phases.append((name, now))
+        self.state = name
+        logger.info(f"Model startup: {name} ({now - self.started_at:.1f}s)")
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def wait(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def status(self):
+        now = time.monotonic()
+        phases = {}
+        for (name, start), (_, end) in zip(self._phases, self._phases[1:] + [(None, now)]):
+            if name != "ready":
+                phases[name] = round(end - start, 3)
+        status = {
+            "status": self.state,
+            "elapsed_s": round(now - self.started_at, 3),
+            "phases": phases,
+        }
+        if self.error is not None:
+            status["error"] = self.error
+        return status
+
+    def _run(self):
+        try:
+            self._build(self)
+        except Exception as e:
+            logger.exception("Model loading failed")
+            self.error = f"{type(e).__name__}: {e}"
+            self.state = "failed"
+            return
+        self._phases.append(("ready", time.monotonic()))
+        self.state = "ready"
+        self._ready.set()
+        logger.info(f"Model ready after {time.monotonic() - self.started_at:.1f}s")
@@ -0,0 +1,118 @@
+import logging
+import threading
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+from app.core.backends import parse_dtype
+
+logger = logging.getLogger(__name__)
+
+
+def cpu_supports_bf16():
+    """Whether the CPU has native bf16 matmuls (AVX512-BF16 or AMX), where bf16 beats float32."""
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def parse_autocast(name):
+    """`"auto"` or empty -> None (the policy decides), `"off"` -> False, else an autocast dtype."""
+    if not name or name == "auto":
+        return None
+    if name in ("off", "false"):
+        return False
+    return parse_dtype(name)
+
+
+class DevicePolicy:
+    """
+    Where and how a backend runs: the device and dtype of its weights, the
+    autocast dtype of its compute, TF32 on CUDA, and the CPU threads used by
+    each thread that runs the model.
+
+    Any field left as None is filled in by `configure`:
+    - device: `cuda` when available, else `cpu`.
+    - dtype: the backend's own dtype on CUDA. On a CPU it is bf16 when the
+      hardware has native bf16 matmuls, else float32.
+    - autocast: bf16 autocast on a CPU with bf16 weights, so stray float32
+      inputs meet bf16 weights and reductions stay in float32. Off otherwise.
+      Pass a dtype to force it on, or False to turn it off.
+
+    `num_threads` is the intra-op thread count of every thread that runs
+    the model (inference workers, streaming decode threads, the batch
+    scheduler). 0 keeps torch's default. With several inference workers on
+    one CPU, cores / workers avoids oversubscribing it.
+    """
+
+    def __init__(self, device=None, dtype=None, autocast=None, num_threads=0, num_interop_threads=0,
+                 allow_tf32=True):
+        self.device = device
+        self.dtype = dtype
+        self.autocast = autocast
+        self.num_threads = num_threads
+        self.num_interop_threads = num_interop_threads
+        self.allow_tf32 = allow_tf32
+        self._local = threading.local()
+
+    @property
+    def device_type(self):
+        return torch.device(self.device).type
+
+    def configure(self, default_dtype):
+        """
+        Resolve the defaults for a backend whose CUDA dtype is
+        `default_dtype` and apply the process-wide settings (TF32, inter-op
+        threads). Returns the resolved policy.
+        """
+        device = self.device or ("cuda" if torch.cuda.is_available() else "cpu")
+        if torch.device(device).type == "cuda":
+            dtype = self.dtype or default_dtype
+        else:
+            dtype = self.dtype or (torch.bfloat16 if cpu_supports_bf16() else torch.float32)
+        autocast = self.autocast
+        if autocast is None:
+            autocast = torch.bfloat16 if torch.device(device).type == "cpu" and dtype == torch.bfloat16 \
+                and cpu_supports_bf16() else False
+        policy = DevicePolicy(device, dtype, autocast, self.num_threads, self.num_interop_threads, self.allow_tf32)
+        policy.apply()
+        return policy
+
+    def apply(self):
+        if self.device_type == "cuda":
+            # TF32 only changes float32 matmuls, on Ampere and newer
+            index = torch.device(self.device).index
+            major, _ = torch.cuda.get_device_capability(index if index is not None else torch.cuda.current_device())
+            tf32 = self.allow_tf32 and major >= 8
+            torch.backends.cuda.matmul.allow_tf32 = tf32
+            torch.backends.cudnn.allow_tf32 = tf32
+        if self.num_interop_threads:
+            try:
+                torch.set_num_interop_threads(self.num_interop_threads)
+            except RuntimeError:
+                # Only settable before the first inter-op parallel work in the process
+                logger.warning(f"Inter-op threads already started; keeping {torch.get_num_interop_threads()}")
+        logger.info(f"Device policy: {self}")
+
+    @contextmanager
+    def inference(self):
+        """Run model code on this thread: its CPU thread count, `torch.inference_mode` and autocast."""
+        if self.num_threads and getattr(self._local, "num_threads", None) != self.num_threads:
+            # Per thread under OpenMP, so every thread that runs the model sets it once
+            torch.set_num_threads(self.num_threads)
+            self._local.num_threads = self.num_threads
+        autocast = torch.autocast(self.device_type, dtype=self.autocast) if self.autocast else nullcontext()
+        with torch.inference_mode(), autocast:
+            yield
+
+    def run(self, fn, *args, **kwargs):
+        """`fn(*args, **kwargs)` under `inference()`, as the target of a thread that runs the model."""
+        with self.inference():
+            return fn(*args, **kwargs)
+
+    def __repr__(self):
+        autocast = str(self.autocast).replace("torch.", "") if self.autocast else "off"
+        return (f"device={self.device} dtype={str(self.dtype).replace('torch.', '')} autocast={autocast} "
+                f"threads={self.num_threads or torch.get_num_threads()} "
+                f"interop_threads={self.num_interop_threads or torch.get_num_interop_threads()}")
@@ -0,0 +1,271 @@
+import asyncio
+import functools
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+from app.core import tracing
+from app.core.metrics import RequestMetrics
+from app.core.usage import Usage
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future, exc):
+    if not future.done():
+        future.set_exception(exc)
+
+
+def _cancel_with(event, future):
+    if future.cancelled():
+        event.set()
+
+
+class TokenChannel:
+    """
+    Carries text chunks from an inference worker thread to an asyncio consumer.
+
+    The worker appends to a deque and only schedules a loop wake-up when the
+    consumer is parked waiting, so a burst of chunks costs a single
+    call_soon_threadsafe instead of one thread hop per chunk.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._items = deque()
+        self._lock = threading.Lock()
+        self._waiter = None
+        self._done = False
+        self._error = None
+        # Handed to the backend, which stops decoding at the next token once it is set
+        self.cancel_event = threading.Event()
+        # Complete once iteration has finished
+        self.usage = Usage()
+
+    def put(self, item):
+        with self._lock:
+            self._items.append(item)
+            waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            self._loop.call_soon_threadsafe(_wake, waiter)
+
+    def close(self, error=None):
+        with self._lock:
+            self._done = True
+            self._error = error
+            waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            self._loop.call_soon_threadsafe(_wake, waiter)
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        # Called from the event loop when the client goes away
+        self.cancel_event.set()
+
+    def drain(self):
+        """Take every chunk that is already buffered without waiting."""
+        with self._lock:
+            items = list(self._items)
+            self._items.clear()
+        return items
+
+    async def wait(self, timeout):
+        """Wait up to `timeout` seconds for a chunk to arrive or the stream to end."""
+        with self._lock:
+            if self._items or self._done:
+                return
+            waiter = self._loop.create_future()
+            self._waiter = waiter
+        timer = self._loop.call_later(timeout, _wake, waiter)
+        try:
+            await waiter
+        finally:
+            timer.cancel()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            with self._lock:
+                if self._items:
+                    return self._items.popleft()
+                if self._done:
+                    if self._error is not None:
+                        raise self._error
+                    raise StopAsyncIteration
+                waiter = self._loop.create_future()
+                self._waiter = waiter
+            await waiter
+
+
+class _Job:
+    __slots__ = ("request", "loop", "future", "channel", "usage", "cancelled", "enqueued_at", "trace",
+                 "enqueued_us")
+
+    def __init__(self, request, loop, future=None, channel=None):
+        self.request = request
+        self.loop = loop
+        self.future = future
+        self.channel = channel
+        self.usage = channel.usage if channel is not None else Usage()
+        # Set once the client is gone: the channel is cancelled, or the awaiting handler is
+        if channel is not None:
+            self.cancelled = channel.cancel_event
+        else:
+            self.cancelled = threading.Event()
+            future.add_done_callback(functools.partial(_cancel_with, self.cancelled))
+        self.enqueued_at = time.monotonic()
+        # The request's trace is carried over from the event loop to the worker thread
+        self.trace = tracing.current()
+        self.enqueued_us = tracing.now_us() if self.trace is not None else None
+
+
+class InferenceExecutor:
+    """
+    Runs chat requests on dedicated worker threads that own the model, so a
+    generation never blocks the asyncio event loop.
+
+    Requests wait in a FIFO queue; with the default single worker the model
+    sees one request at a time and concurrent clients simply queue up.
+    """
+
+    def __init__(self, chat_model, num_workers=1, max_queue_size=0):
+        self.chat_model = chat_model
+        backend = type(getattr(chat_model, "model", chat_model)).__name__
+        self._metrics = {
+            True: RequestMetrics(backend, "stream"),
+            False: RequestMetrics(backend, "non-stream"),
+        }
+        self._jobs = queue.Queue(maxsize=max_queue_size)
+        self._workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(target=self._run, name=f"inference-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    @property
+    def queue_size(self):
+        return self._jobs.qsize()
+
+    async def submit(self, request, on_admit=None):
+        """
+        Run a non-streaming request and return the backend's `(answer, usage)`.
+
+        `on_admit(request)` is called once the request has a place in the
+        queue, before any worker can pick it up; if it raises, the request is
+        not queued.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._enqueue(_Job(request, loop, future=future), on_admit)
+        return await future
+
+    def stream(self, request, on_admit=None):
+        """Queue a streaming request and return a TokenChannel to iterate with `async for`."""
+        loop = asyncio.get_running_loop()
+        channel = TokenChannel(loop)
+        self._enqueue(_Job(request, loop, channel=channel), on_admit)
+        return channel
+
+    def shutdown(self):
+        for _ in self._workers:
+            self._jobs.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _enqueue(self, job, on_admit=None):
+        # Only the event loop adds jobs, so the queue cannot fill up between the check and the put
+        if self._jobs.full():
+            raise QueueFullError(f"Inference queue is full ({self._jobs.maxsize} pending requests)")
+        if on_admit is not None:
+            on_admit(job.request)
+        self._jobs.put_nowait(job)
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            metrics = self._metrics[job.channel is not None]
+            waited = time.monotonic() - job.enqueued_at
+            metrics.queue_wait.observe(waited)
+            logger.debug("job picked up after %.3fs in queue", waited)
+            job.usage.inter_token = metrics.inter_token
+            metrics.in_progress.inc()
+            token = None
+            if job.trace is not None:
+                job.trace.add("queue", job.enqueued_us, tracing.now_us())
+                token = tracing.activate(job.trace)
+            try:
+                with tracing.span("inference"):
+                    if job.channel is not None:
+                        status = self._run_stream(job)
+                    else:
+                        status = self._run_once(job)
+            finally:
+                metrics.in_progress.dec()
+                if token is not None:
+                    tracing.deactivate(token)
+            metrics.finished(job.usage, job.enqueued_at, status)
+
+    def _run_once(self, job):
+        if job.future.cancelled():
+            return "cancelled"
+        try:
+            result = self.chat_model.chat(job.request, usage=job.usage, cancelled=job.cancelled)
+        except Exception as e:
+            logger.exception("inference failed")
+            job.loop.call_soon_threadsafe(_set_exception, job.future, e)
+            return "error"
+        job.loop.call_soon_threadsafe(_set_result, job.future, (result, job.usage))
+        return "ok"
+
+    def _run_stream(self, job):
+        channel = job.channel
+        if channel.cancelled:
+            channel.close()
+            return "cancelled"
+        status = "ok"
+        answer = None
+        try:
+            answer = self.chat_model.chat(job.request, usage=job.usage, cancelled=job.cancelled)
+            if isinstance(answer, str):
+                # Backends without streaming support (and error messages) return
+                # the whole answer at once; send it as one chunk, not per character
+                answer = [answer]
+            for text in answer:
+                if channel.cancelled:
+                    status = "cancelled"
+                    break
+                channel.put(text)
+        except Exception as e:
+            logger.exception("streaming inference failed")
+            channel.close(e)
+            status = "error"
+        else:
+            channel.close()
+        finally:
+            close = getattr(answer, "close", None)
+            if close is not None:
+                close()
+        return status
@@ -0,0 +1,104 @@
+import base64
+import io
+import logging
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+class ImageDecodeError(Exception):
+    pass
+
+
+class ImageTooLargeError(ImageDecodeError):
+    pass
+
+
+def _reduce_factor(size, min_size, min_area):
+    if not min_size and not min_area:
+        return 1
+    w, h = size
+    factor = w * h
+    if min_size:
+        factor = min(factor, w // max(min_size[0], 1), h // max(min_size[1], 1))
+    if min_area:
+        factor = min(factor, int(math.sqrt(w * h / min_area)))
+    return max(factor, 1)
+
+
+def decode_image(data, min_size=None, min_area=None, max_pixels=0):
+    """
+    Decode a base64 string (or raw bytes) into an RGB PIL image that is no
+    larger than the model needs.
+
+    The result is at least `min_size` (width, height) in each dimension and
+    at least `min_area` pixels. JPEGs are decoded in draft mode, which lets
+    libjpeg scale the DCT by 1/2, 1/4 or 1/8 instead of decoding every pixel;
+    other formats are box-reduced by an integer factor after decoding.
+    Images that would still decode to more than `max_pixels` are rejected
+    before any pixel data is read.
+    """
+    try:
+        raw = base64.b64decode(data) if isinstance(data, str) else data
+        # BytesIO shares the buffer of an immutable bytes object instead of copying it
+        image = Image.open(io.BytesIO(raw))
+        if image.format == "JPEG":
+            factor = _reduce_factor(image.size, min_size, min_area)
+            if factor > 1:
+                image.draft("RGB", (math.ceil(image.size[0] / factor), math.ceil(image.size[1] / factor)))
+        if max_pixels and image.size[0] * image.size[1] > max_pixels:
+            raise ImageTooLargeError(
+                f"Image of {image.size[0]}x{image.size[1]} exceeds the {max_pixels} pixel budget")
+        image = image.convert("RGB")
+    except ImageDecodeError:
+        raise
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e))
+    except Exception as e:
+        raise ImageDecodeError(f"Image decode error: {e}")
+
+    factor = _reduce_factor(image.size, min_size, min_area)
+    if factor > 1:
+        image = image.reduce(factor)
+    return image
+
+
+class ImageDecoder:
+    """
+    Decodes request images in a pool of worker processes so large uploads
+    neither hold the GIL on the inference threads nor keep full-resolution
+    buffers in the server process. With `num_workers=0` images are decoded
+    inline on the calling thread.
+
+    Workers are spawned rather than forked because the server process already
+    holds a CUDA context by the time the pool starts.
+    """
+
+    def __init__(self, num_workers=0, max_pixels=0):
+        self.max_pixels = max_pixels
+        self._pool = None
+        if num_workers > 0:
+            self._pool = ProcessPoolExecutor(
+                max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"))
+            logger.info(f"Image decode pool started ({num_workers} processes, max_pixels={max_pixels})")
+
+    def decode(self, data, min_size=None, min_area=None):
+        return self.decode_many([data], min_size=min_size, min_area=min_area)[0]
+
+    def decode_many(self, payloads, min_size=None, min_area=None):
+        """Decode several images concurrently and return them in order."""
+        if self._pool is None:
+            return [decode_image(data, min_size, min_area, self.max_pixels) for data in payloads]
+        futures = [
+            self._pool.submit(decode_image, data, min_size, min_area, self.max_pixels)
+            for data in payloads
+        ]
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
@@ -0,0 +1,243 @@
+import asyncio
+import ipaddress
+import logging
+import re
+import socket
+import time
+from collections import OrderedDict
+
+import httpx
+
+from app.core.image_decode import ImageDecodeError
+
+logger = logging.getLogger(__name__)
+
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+
+class ImageFetchError(ImageDecodeError):
+    pass
+
+
+def is_public_address(address):
+    """Whether an IP address is globally routable: not private, loopback, link-local, reserved or multicast."""
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def remote_image_urls(request):
+    """http(s) `image_url`s of a chat request, in order and without duplicates."""
+    urls = []
+    for message in request.messages:
+        if not isinstance(message.content, list):
+            continue
+        for item in message.content:
+            if isinstance(item, dict) and item.get('type') == "image_url":
+                url = item.get('image_url', {}).get('url', '')
+                if url.startswith(("http://", "https://")) and url not in urls:
+                    urls.append(url)
+    return urls
+
+
+class _Entry:
+    __slots__ = ("data", "etag", "last_modified", "expires_at")
+
+    def __init__(self, data, etag, last_modified, expires_at):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires_at = expires_at
+
+
+class ImageFetcher:
+    """
+    Downloads remote `image_url`s on the event loop with a shared, pooled
+    HTTP client.
+
+    Fetched bytes are kept in an LRU cache for `ttl` seconds (or the
+    response's `max-age`) and revalidated with `If-None-Match` /
+    `If-Modified-Since` once stale. Concurrent requests for the same URL
+    share one download. Each download is limited to `max_bytes` and
+    `timeout` seconds overall.
+
+    The URLs come from clients, so fetching is off unless `enabled`. When
+    `allowed_hosts` is given, only those hosts (or, for entries starting
+    with a dot, their subdomains) are fetched. Every host is resolved before
+    connecting and refused if any of its addresses is not public, unless
+    `allow_private`; the connection then goes to the checked address, so a
+    second DNS answer cannot redirect it. Redirects are followed by hand, up
+    to `max_redirects`, and each hop is checked the same way.
+    """
+
+    def __init__(self, timeout=10.0, max_bytes=20 * 1024 * 1024, cache_bytes=128 * 1024 * 1024,
+                 ttl=300, max_connections=32, client=None, enabled=False, allowed_hosts=(),
+                 allow_private=False, max_redirects=5):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.cache_bytes = cache_bytes
+        self.ttl = ttl
+        self.enabled = enabled
+        self.allowed_hosts = {host.lower() for host in allowed_hosts}
+        self.allow_private = allow_private
+        self.max_redirects = max_redirects
+        self.current_bytes = 0
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._client = client or httpx.AsyncClient(
+            timeout=timeout,
+            follow_redirects=False,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    def prefetch(self, request):
+        """
+        Start downloading every remote image of `request` and attach the
+        downloads to it. The inference worker picks up the bytes with
+        `request.remote_image(url)`, so the fetches overlap with queueing and
+        message parsing. Must be called on the event loop.
+
+        Raises ImageFetchError, before anything is downloaded, if fetching is
+        disabled or a URL's host is not allowed.
+        """
+        urls = remote_image_urls(request)
+        for url in urls:
+            self.check_url(url)
+        loop = asyncio.get_running_loop()
+        for url in urls:
+            request.add_remote_image(url, asyncio.run_coroutine_threadsafe(self.fetch(url), loop))
+
+    def check_url(self, url):
+        """Raise ImageFetchError unless fetching is enabled and `url` is http(s) on an allowed host."""
+        if not self.enabled:
+            raise ImageFetchError("Fetching image URLs is disabled; send images as data: URLs")
+        url = httpx.URL(url)
+        if url.scheme not in ("http", "https") or not url.host:
+            raise ImageFetchError(f"Image URL {url} is not an http(s) URL")
+        if self.allowed_hosts and not self._host_allowed(url.host):
+            raise ImageFetchError(f"Image host {url.host} is not allowed")
+
+    def _host_allowed(self, host):
+        host = host.lower()
+        return any(host == allowed or (allowed.startswith(".") and host.endswith(allowed))
+                   for allowed in self.allowed_hosts)
+
+    async def _resolve(self, url):
+        """A checked address to connect to for `url`'s host."""
+        port = url.port or (443 if url.scheme == "https" else 80)
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(url.host, port, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            raise ImageFetchError(f"Cannot resolve image host {url.host}: {e}")
+        addresses = [info[4][0] for info in infos]
+        if not self.allow_private:
+            for address in addresses:
+                if not is_public_address(address):
+                    raise ImageFetchError(f"Image host {url.host} resolves to a non-public address ({address})")
+        return addresses[0]
+
+    async def fetch(self, url):
+        self.check_url(url)
+        entry = self._entries.get(url)
+        if entry is not None and entry.expires_at > time.monotonic():
+            self._entries.move_to_end(url)
+            self.hits += 1
+            return entry.data
+        task = self._inflight.get(url)
+        if task is None:
+            task = asyncio.ensure_future(self._download(url, entry))
+            self._inflight[url] = task
+            task.add_done_callback(lambda _: self._inflight.pop(url, None))
+        return await asyncio.shield(task)
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.cache_bytes,
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+        }
+
+    async def _download(self, url, entry):
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        try:
+            return await asyncio.wait_for(self._get(url, entry, headers), self.timeout)
+        except asyncio.TimeoutError:
+            raise ImageFetchError(f"Timed out fetching image {url}")
+        except httpx.HTTPError as e:
+            raise ImageFetchError(f"Failed to fetch image {url}: {e}")
+
+    async def _get(self, url, entry, headers):
+        location = httpx.URL(url)
+        for _ in range(self.max_redirects + 1):
+            address = await self._resolve(location)
+            # Connect to the address that was checked; Host and TLS still name the original host
+            target = location.copy_with(host=address)
+            hop_headers = dict(headers, Host=location.netloc.decode("ascii"))
+            extensions = {"sni_hostname": location.host} if location.scheme == "https" else {}
+            async with self._client.stream("GET", target, headers=hop_headers, extensions=extensions) as response:
+                if not response.has_redirect_location:
+                    return await self._read(url, entry, response)
+            location = location.join(response.headers["Location"])
+            self.check_url(str(location))
+        raise ImageFetchError(f"Too many redirects fetching image {url}")
+
+    async def _read(self, url, entry, response):
+        if response.status_code == 304 and entry is not None:
+            self.revalidated += 1
+            entry.expires_at = time.monotonic() + self._max_age(response)
+            if url in self._entries:
+                self._entries.move_to_end(url)
+            return entry.data
+        if response.status_code != 200:
+            raise ImageFetchError(f"Failed to fetch image {url}: HTTP {response.status_code}")
+        length = response.headers.get("Content-Length")
+        if length is not None and int(length) > self.max_bytes:
+            raise ImageFetchError(f"Image {url} is larger than {self.max_bytes} bytes")
+        chunks = []
+        size = 0
+        async for chunk in response.aiter_bytes():
+            size += len(chunk)
+            if size > self.max_bytes:
+                raise ImageFetchError(f"Image {url} is larger than {self.max_bytes} bytes")
+            chunks.append(chunk)
+        data = b"".join(chunks)
+        self.misses += 1
+        self._store(url, data, response)
+        return data
+
+    def _max_age(self, response):
+        match = _MAX_AGE_RE.search(response.headers.get("Cache-Control", ""))
+        return int(match.group(1)) if match else self.ttl
+
+    def _store(self, url, data, response):
+        old = self._entries.pop(url, None)
+        if old is not None:
+            self.current_bytes -= len(old.data)
+        cache_control = response.headers.get("Cache-Control", "")
+        if "no-store" in cache_control or len(data) > self.cache_bytes:
+            return
+        self._entries[url] = _Entry(
+            data,
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+            time.monotonic() + self._max_age(response),
+        )
+        self.current_bytes += len(data)
+        while self.current_bytes > self.cache_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= len(evicted.data)
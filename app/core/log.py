@@ -0,0 +1,112 @@
+import hashlib
+import json
+import logging
+import logging.handlers
+import queue
+
+# Attributes every LogRecord has; anything else was passed through `extra=`
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, including any fields passed with `extra=`."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "location": f"{record.pathname}:{record.lineno}",
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler.prepare renders the message on the calling thread so the
+    # record can be pickled; the queue here never leaves the process, so the
+    # record is passed through untouched and the listener thread formats it.
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level="INFO", log_format=None, log_file=None, json_logs=False):
+    """
+    Route every log record through an in-memory queue to a background
+    thread that formats and writes it, so request threads never block on
+    the console or disk. Returns the listener; call `stop()` on shutdown to
+    flush what is still queued.
+    """
+    formatter = JsonFormatter() if json_logs else logging.Formatter(log_format)
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_DeferredQueueHandler(log_queue))
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def _summarize_content(content):
+    if isinstance(content, str):
+        return {"type": "text", "chars": len(content)}
+    if isinstance(content, dict):
+        if content.get("type") == "text":
+            return {"type": "text", "chars": len(content.get("text", ""))}
+        if content.get("type") == "image_url":
+            url = content.get("image_url", {}).get("url", "")
+            header, _, payload = url.partition(",")
+            if header.startswith("data:"):
+                digest = hashlib.blake2b(payload.encode(), digest_size=6).hexdigest()
+                return {"type": "image", "hash": digest, "bytes": len(payload) * 3 // 4}
+            return {"type": "image", "url": url}
+        return {"type": content.get("type")}
+    size = getattr(content, "size", None)
+    if size is not None:
+        return {"type": "image", "size": list(size)}
+    return {"type": type(content).__name__}
+
+
+def _summarize_message(role, content):
+    if isinstance(content, list):
+        parts = [_summarize_content(item) for item in content]
+    else:
+        parts = [_summarize_content(content)]
+    return {"role": role, "content": parts}
+
+
+class MessagesSummary:
+    """
+    Log argument that renders a compact description of chat messages, with
+    text reduced to its length and images to a hash and size, only when the
+    record is actually formatted. Accepts request messages or the backends'
+    processed `{"role", "content"}` dicts.
+    """
+
+    __slots__ = ("messages",)
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    def __str__(self):
+        summary = []
+        for message in self.messages:
+            if isinstance(message, dict):
+                summary.append(_summarize_message(message.get("role"), message.get("content")))
+            else:
+                summary.append(_summarize_message(message.role, message.content))
+        return json.dumps(summary, ensure_ascii=False)
@@ -0,0 +1,381 @@
+import bisect
+import math
+import os
+import resource
+import threading
+import time
+import weakref
+
+import torch
+
+# Seconds; covers everything from a single decode step to a long generation
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class _ShardOwner:
+    """Kept in a thread's local storage only, so it is freed when the thread exits."""
+
+    __slots__ = ("__weakref__",)
+
+
+class _Sharded:
+    """
+    Per-thread storage for one labelled series.
+
+    Every thread updates only its own shard, so recording needs no lock and
+    no update is ever lost; a scrape sums the shards and may be a few
+    updates behind, which is all Prometheus needs. When a thread exits
+    (e.g. a per-request generate thread), its shard is folded into
+    `_retired`, so the number of shards stays bounded by the live threads.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._local = threading.local()
+        self._shards = []
+        self._retired = [0.0] * size
+        # Only taken when a thread's shard is created or retired, and by scrapes
+        self._lock = threading.Lock()
+
+    def shard(self):
+        values = getattr(self._local, "values", None)
+        if values is None:
+            values = self._local.values = [0.0] * self._size
+            self._local.owner = owner = _ShardOwner()
+            with self._lock:
+                self._shards.append(values)
+            weakref.finalize(owner, self._retire, values)
+        return values
+
+    def _retire(self, values):
+        with self._lock:
+            self._shards = [shard for shard in self._shards if shard is not values]
+            for i, v in enumerate(values):
+                self._retired[i] += v
+
+    def totals(self):
+        with self._lock:
+            shards = list(self._shards)
+            totals = list(self._retired)
+        for values in shards:
+            for i, v in enumerate(values):
+                totals[i] += v
+        return totals
+
+
+class _CounterChild(_Sharded):
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount=1.0):
+        self.shard()[0] += amount
+
+
+class _GaugeChild(_Sharded):
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount=1.0):
+        self.shard()[0] += amount
+
+    def dec(self, amount=1.0):
+        self.shard()[0] -= amount
+
+
+class _HistogramChild(_Sharded):
+    def __init__(self, buckets):
+        # One slot per bucket, then +Inf, sum
+        super().__init__(len(buckets) + 2)
+        self.buckets = buckets
+
+    def observe(self, value):
+        values = self.shard()
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def labels(self, *values, **kwargs):
+        """Return the series for these label values; bind it once outside hot loops."""
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Counter summed from per-thread `inc`, or read from a callback at scrape time."""
+
+    kind = "counter"
+
+    def __init__(self, registry, name, documentation, labelnames=(), function=None):
+        super().__init__(registry, name, documentation, labelnames)
+        # function() returns a {label values tuple: value} mapping of totals since start
+        self.function = function
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def samples(self):
+        if self.function is not None:
+            items = self.function().items()
+        else:
+            items = ((key, child.totals()[0]) for key, child in list(self._children.items()))
+        for key, value in items:
+            yield self.name + "_total", _format_labels(self.labelnames, key), value
+
+
+class Gauge(_Metric):
+    """Gauge summed from per-thread `inc`/`dec`, or read from a callback at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, registry, name, documentation, labelnames=(), function=None):
+        super().__init__(registry, name, documentation, labelnames)
+        # function() returns a {label values tuple: value} mapping
+        self.function = function
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def samples(self):
+        if self.function is not None:
+            items = self.function().items()
+        else:
+            items = ((key, child.totals()[0]) for key, child in list(self._children.items()))
+        for key, value in items:
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(registry, name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def samples(self):
+        for key, child in list(self._children.items()):
+            totals = child.totals()
+            cumulative = 0.0
+            for bound, count in zip(self.buckets + (math.inf,), totals[:-1]):
+                cumulative += count
+                yield (self.name + "_bucket",
+                       _format_labels(self.labelnames, key, [("le", _format_value(bound))]), cumulative)
+            yield self.name + "_count", _format_labels(self.labelnames, key), cumulative
+            yield self.name + "_sum", _format_labels(self.labelnames, key), totals[-1]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+requests_total = Counter(
+    REGISTRY, "minicpm_requests", "Chat requests completed, by outcome.", ("backend", "mode", "status"))
+requests_in_progress = Gauge(
+    REGISTRY, "minicpm_requests_in_progress", "Chat requests being generated.", ("backend", "mode"))
+queue_wait_seconds = Histogram(
+    REGISTRY, "minicpm_queue_wait_seconds", "Time a request waited for an inference worker.", ("backend", "mode"))
+image_decode_seconds = Histogram(
+    REGISTRY, "minicpm_image_decode_seconds", "Time to decode the images of one request.", ("backend",))
+vision_encode_seconds = Histogram(
+    REGISTRY, "minicpm_vision_encode_seconds",
+    "Time to embed one prompt, vision tower included.", ("backend",))
+prefill_seconds = Histogram(
+    REGISTRY, "minicpm_prefill_seconds", "Time from the start of generation to the first token.", ("backend", "mode"))
+time_to_first_token_seconds = Histogram(
+    REGISTRY, "minicpm_time_to_first_token_seconds",
+    "Time from the request being queued to its first generated token.", ("backend", "mode"))
+inter_token_seconds = Histogram(
+    REGISTRY, "minicpm_inter_token_seconds", "Time between consecutive generated tokens.", ("backend", "mode"))
+tokens_per_second = Histogram(
+    REGISTRY, "minicpm_tokens_per_second", "Decode speed of one request after its first token.",
+    ("backend", "mode"), buckets=RATE_BUCKETS)
+prompt_tokens_total = Counter(
+    REGISTRY, "minicpm_prompt_tokens", "Prompt tokens processed, image tokens included.", ("backend", "mode"))
+completion_tokens_total = Counter(
+    REGISTRY, "minicpm_completion_tokens", "Tokens generated.", ("backend", "mode"))
+
+
+def timed(fn, series, synchronize=None):
+    """
+    Wrap `fn` so every call's duration is observed into a histogram series.
+    `synchronize` (e.g. `torch.cuda.synchronize`) is called before each
+    clock reading, so work `fn` only queues on a device is timed as well.
+    """
+    def wrapper(*args, **kwargs):
+        if synchronize is not None:
+            synchronize()
+        start = time.monotonic()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if synchronize is not None:
+                synchronize()
+            series.observe(time.monotonic() - start)
+    return wrapper
+
+
+class RequestMetrics:
+    """Histogram and counter series of one backend and mode, bound once so recording is a few list updates."""
+
+    def __init__(self, backend, mode):
+        labels = (backend, mode)
+        self.backend = backend
+        self.mode = mode
+        self.in_progress = requests_in_progress.labels(*labels)
+        self.queue_wait = queue_wait_seconds.labels(*labels)
+        self.prefill = prefill_seconds.labels(*labels)
+        self.time_to_first_token = time_to_first_token_seconds.labels(*labels)
+        self.inter_token = inter_token_seconds.labels(*labels)
+        self.tokens_per_second = tokens_per_second.labels(*labels)
+        self.prompt_tokens = prompt_tokens_total.labels(*labels)
+        self.completion_tokens = completion_tokens_total.labels(*labels)
+
+    def finished(self, usage, enqueued_at, status):
+        requests_total.labels(self.backend, self.mode, status).inc()
+        self.prompt_tokens.inc(usage.prompt_tokens)
+        self.completion_tokens.inc(usage.completion_tokens)
+        if usage.first_token_at is None:
+            return
+        self.time_to_first_token.observe(usage.first_token_at - enqueued_at)
+        if usage.generation_started_at is not None:
+            self.prefill.observe(usage.first_token_at - usage.generation_started_at)
+        decode_time = usage.last_token_at - usage.first_token_at
+        if usage.completion_tokens > 1 and decode_time > 0:
+            self.tokens_per_second.observe((usage.completion_tokens - 1) / decode_time)
+
+
+# Filled in by the process that owns the model (see `bind_model_gauges`)
+_gauge_sources = {"queue": None, "scheduler": None, "caches": {}}
+
+
+def bind_model_gauges(executor=None, scheduler=None, caches=None):
+    """Point the scrape-time gauges at the running executor, scheduler and caches (objects with `stats()`)."""
+    _gauge_sources["queue"] = executor
+    _gauge_sources["scheduler"] = scheduler
+    _gauge_sources["caches"] = dict(caches or {})
+
+
+def _queued():
+    executor = _gauge_sources["queue"]
+    return {(): executor.queue_size} if executor is not None else {}
+
+
+def _sequences():
+    scheduler = _gauge_sources["scheduler"]
+    if scheduler is None:
+        return {}
+    return {("running",): scheduler.num_running, ("waiting",): scheduler.num_waiting}
+
+
+def _cache_stat(field):
+    def read():
+        return {
+            (name,): cache.stats().get(field, 0)
+            for name, cache in _gauge_sources["caches"].items()
+        }
+    return read
+
+
+def _memory():
+    values = {("cpu", kind): size for kind, size in process_memory().items()}
+    if torch.cuda.is_available():
+        values[("gpu", "allocated")] = torch.cuda.memory_allocated()
+        values[("gpu", "reserved")] = torch.cuda.memory_reserved()
+    return values
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # ru_maxrss is the peak, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def process_memory():
+    """
+    Resident memory of this process in bytes. Where the kernel reports it, RSS
+    is split into pages shared with other processes (e.g. model weights
+    mapped by every worker) and private ones, plus PSS, which divides each
+    shared page among the processes mapping it.
+    """
+    memory = {"rss": _rss_bytes()}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            fields = {}
+            for line in f:
+                name, _, value = line.partition(":")
+                if value.strip().endswith(" kB"):
+                    fields[name] = int(value.split()[0]) * 1024
+    except OSError:
+        return memory
+    memory["pss"] = fields.get("Pss", 0)
+    memory["shared"] = fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0)
+    memory["private"] = fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)
+    return memory
+
+
+Gauge(REGISTRY, "minicpm_queued_requests", "Requests waiting for an inference worker.", function=_queued)
+Gauge(REGISTRY, "minicpm_batch_sequences", "Sequences in the continuous batch.", ("state",), function=_sequences)
+Counter(REGISTRY, "minicpm_cache_hits", "Cache hits since start.", ("cache",), function=_cache_stat("hits"))
+Counter(REGISTRY, "minicpm_cache_misses", "Cache misses since start.", ("cache",), function=_cache_stat("misses"))
+Gauge(REGISTRY, "minicpm_cache_hit_ratio", "Cache hit ratio since start.", ("cache",), function=_cache_stat("hit_rate"))
+Gauge(REGISTRY, "minicpm_cache_bytes", "Bytes held by each cache.", ("cache",), function=_cache_stat("bytes"))
+Gauge(REGISTRY, "minicpm_memory_bytes", "Process and GPU memory.", ("device", "kind"), function=_memory)
@@ -0,0 +1,130 @@
+import queue
+
+from transformers.generation.streamers import BaseStreamer
+
+from app.core import tracing
+
+
+class IncrementalDetokenizer:
+    """
+    Turns a growing sequence of token ids into text chunks.
+
+    Only the tokens from `prefix_offset` on are decoded at each step, so the
+    cost per token stays constant instead of re-decoding the whole output.
+    The few tokens before `read_offset` are kept as context because
+    SentencePiece/byte-level tokenizers render a token differently depending on
+    its neighbours, and nothing is emitted while the decoded window ends in an
+    incomplete UTF-8 sequence (a CJK character or emoji split over several
+    Llama 3 byte tokens).
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens=True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def _decode(self, token_ids):
+        return self.tokenizer.decode(token_ids, skip_special_tokens=self.skip_special_tokens)
+
+    def append(self, token_id):
+        """Add one token and return the newly stable text (possibly empty)."""
+        self.token_ids.append(token_id)
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+    def flush(self):
+        """Return whatever is still held back once generation has finished."""
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+
+def _count_generated(usage, value):
+    # `generate` first puts the prompt ids, which are empty when it is given
+    # `inputs_embeds` (the only way these backends call it), so every id seen
+    # here is a generated one.
+    if usage is not None:
+        usage.add_tokens(value.numel())
+
+
+class TokenCounter(BaseStreamer):
+    """`generate` streamer that only counts generated tokens into a Usage."""
+
+    def __init__(self, usage):
+        self.usage = usage
+        self.tracer = tracing.step_tracer()
+
+    def put(self, value):
+        _count_generated(self.usage, value)
+        if self.tracer is not None and value.numel():
+            self.tracer.step()
+
+    def end(self, error=None):
+        pass
+
+
+class TokenStreamer(BaseStreamer):
+    """
+    `generate` streamer that yields text chunks through an IncrementalDetokenizer.
+
+    Works like `TextIteratorStreamer` (generation runs on another thread, the
+    consumer iterates), but `TextIteratorStreamer` re-decodes everything since
+    the last newline on every token. Empty puts, which is how `generate`
+    reports the prompt when it is given `inputs_embeds`, are ignored. Generated
+    tokens are counted into `usage` when one is given.
+
+    `end(error)` ends the stream with an error that the consumer gets raised
+    after the text before it. Only the first `end` counts, so a generate
+    thread can always call it in a `finally`.
+    """
+
+    _END = object()
+
+    def __init__(self, tokenizer, skip_special_tokens=True, timeout=None, usage=None):
+        self.detokenizer = IncrementalDetokenizer(tokenizer, skip_special_tokens=skip_special_tokens)
+        self.text_queue = queue.Queue()
+        self.timeout = timeout
+        self.usage = usage
+        self.tracer = tracing.step_tracer()
+        self._ended = False
+
+    def put(self, value):
+        if len(value.shape) > 1 and value.shape[0] > 1:
+            raise ValueError("TokenStreamer only supports batch size 1")
+        _count_generated(self.usage, value)
+        if self.tracer is not None and value.numel():
+            self.tracer.step()
+        for token_id in value.reshape(-1).tolist():
+            text = self.detokenizer.append(token_id)
+            if text:
+                self.text_queue.put(text)
+        if self.tracer is not None:
+            self.tracer.trace.add("detokenize", self.tracer.last, tracing.now_us())
+
+    def end(self, error=None):
+        if self._ended:
+            return
+        self._ended = True
+        text = self.detokenizer.flush()
+        if text:
+            self.text_queue.put(text)
+        self.text_queue.put(error if error is not None else self._END)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        value = self.text_queue.get(timeout=self.timeout)
+        if value is self._END:
+            raise StopIteration
+        if isinstance(value, Exception):
+            raise value
+        return value
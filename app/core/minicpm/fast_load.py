@@ -0,0 +1,294 @@
+"""
+Checkpoint loading for the serving backends.
+
+`from_pretrained` followed by `.to(device, dtype)` allocates every module with
+random weights, reads each shard into memory, copies it into those weights
+and then makes another pass to cast and move them. Here the model is built on
+the meta device (no allocations), safetensors shards are memory-mapped and
+their tensors are cast and moved straight into place, several shards at a
+time.
+
+    python -m app.core.minicpm.fast_load openbmb/MiniCPM-Llama3-V-2_5 /models/minicpm-v-2_5-fp16 --dtype float16
+
+writes a serving artifact: the checkpoint already cast to the serving dtype,
+so later loads skip the cast, plus the tokenizer and config, so it can be
+used as MODEL_PATH.
+
+On the CPU, weights loaded from an artifact in the serving dtype are never
+copied: they stay memory-mapped, so processes loading the same artifact
+share one copy of them in the page cache. `shared_checkpoint` uses that
+to let every server worker map the same weights.
+"""
+import argparse
+import fcntl
+import gc
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from accelerate import init_empty_weights
+from transformers import AutoConfig, AutoModel
+
+logger = logging.getLogger(__name__)
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+class _Phases:
+    """Wall time of each named loading phase, reported as one log line."""
+
+    def __init__(self):
+        self.timings = []
+        self.notes = {}
+
+    def run(self, name):
+        return _Phase(self, name)
+
+    def report(self, model_path):
+        total = sum(seconds for _, seconds in self.timings)
+        parts = ", ".join(
+            f"{name} {seconds:.2f}s" + (f" ({self.notes[name]})" if name in self.notes else "")
+            for name, seconds in self.timings)
+        logger.info(f"Loaded {model_path} in {total:.2f}s: {parts}")
+
+
+class _Phase:
+    def __init__(self, phases, name):
+        self.phases = phases
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.monotonic()
+
+    def __exit__(self, *exc):
+        self.phases.timings.append((self.name, time.monotonic() - self.start))
+        return False
+
+
+def safetensors_files(model_path):
+    """Local paths of the checkpoint's safetensors shards (downloading them if needed), or [] if it has none."""
+    if os.path.isdir(model_path):
+        def resolve(filename):
+            path = os.path.join(model_path, filename)
+            return path if os.path.exists(path) else None
+    else:
+        from huggingface_hub import hf_hub_download
+
+        def resolve(filename):
+            try:
+                return hf_hub_download(model_path, filename)
+            except Exception:
+                return None
+
+    index = resolve("model.safetensors.index.json")
+    if index is not None:
+        with open(index) as f:
+            filenames = sorted(set(json.load(f)["weight_map"].values()))
+        return [resolve(filename) for filename in filenames]
+    single = resolve("model.safetensors")
+    return [single] if single is not None else []
+
+
+def mmap_safetensors(path):
+    """
+    `{name: tensor}` for one safetensors file, backed by a private
+    copy-on-write mapping of it: nothing is read until a tensor is used, and
+    pages stay shared with the page cache unless written to.
+    """
+    with open(path, "rb") as f:
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_len))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    base = 8 + header_len
+    tensors = {}
+    with warnings.catch_warnings():
+        # frombuffer warns about non-writable buffers; ACCESS_COPY mappings are writable
+        warnings.simplefilter("ignore", UserWarning)
+        for name, info in header.items():
+            if name == "__metadata__":
+                continue
+            dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+            start, end = info["data_offsets"]
+            count = (end - start) // dtype.itemsize
+            tensor = torch.frombuffer(buffer, dtype=dtype, count=count, offset=base + start) if count else \
+                torch.empty(0, dtype=dtype)
+            tensors[name] = tensor.view(info["shape"])
+    return tensors
+
+
+def _set_tensor(model, name, tensor):
+    module_name, _, attribute = name.rpartition(".")
+    try:
+        module = model.get_submodule(module_name)
+    except AttributeError:
+        return False
+    if attribute in module._parameters:
+        module._parameters[attribute] = torch.nn.Parameter(tensor, requires_grad=False)
+    elif attribute in module._buffers:
+        module._buffers[attribute] = tensor
+    else:
+        return False
+    return True
+
+
+def _load_shard(model, path, dtype, device):
+    unexpected = []
+    size = 0
+    for name, tensor in mmap_safetensors(path).items():
+        target_dtype = dtype if tensor.is_floating_point() else tensor.dtype
+        # One copy from the mapping into the target device and dtype; on CPU
+        # with a matching dtype the tensor stays mapped
+        value = tensor.to(device=device, dtype=target_dtype)
+        size += tensor.numel() * tensor.element_size()
+        if not _set_tensor(model, name, value):
+            unexpected.append(name)
+    return unexpected, size
+
+
+def load_pretrained(model_class, model_path, dtype, device, num_threads=8, trust_remote_code=False,
+                    **model_kwargs):
+    """
+    `model_class.from_pretrained(model_path, torch_dtype=dtype).to(device)`,
+    built on the meta device and filled from memory-mapped safetensors shards
+    on `num_threads` threads. Checkpoints without safetensors go through
+    `from_pretrained`. `model_class` may be `AutoModel` for remote-code models.
+    """
+    phases = _Phases()
+    with phases.run("resolve"):
+        shards = safetensors_files(model_path)
+    if not shards:
+        logger.info(f"{model_path} has no safetensors shards, loading with from_pretrained")
+        with phases.run("from_pretrained"):
+            model = model_class.from_pretrained(
+                model_path, torch_dtype=dtype, low_cpu_mem_usage=True, trust_remote_code=trust_remote_code,
+                **model_kwargs)
+        with phases.run("to_device"):
+            model = model.to(device=device, dtype=dtype)
+        phases.report(model_path)
+        return model
+
+    with phases.run("config"):
+        if model_class is AutoModel:
+            config = AutoConfig.from_pretrained(model_path, trust_remote_code=trust_remote_code)
+        else:
+            config = model_class.config_class.from_pretrained(model_path)
+        config.torch_dtype = dtype
+
+    with phases.run("init"):
+        # Parameters go to the meta device; buffers (e.g. rotary tables) are still built for real
+        with init_empty_weights():
+            if model_class is AutoModel:
+                model = AutoModel.from_config(config, trust_remote_code=trust_remote_code, **model_kwargs)
+            else:
+                model = model_class(config, **model_kwargs)
+
+    with phases.run("weights"):
+        unexpected, total_bytes = [], 0
+        # Shards hold disjoint tensors, so threads can fill the model concurrently
+        with ThreadPoolExecutor(max_workers=max(1, min(num_threads, len(shards))),
+                                thread_name_prefix="weight-loader") as pool:
+            for extra, size in pool.map(lambda path: _load_shard(model, path, dtype, device), shards):
+                unexpected.extend(extra)
+                total_bytes += size
+    seconds = phases.timings[-1][1]
+    phases.notes["weights"] = (f"{total_bytes / 1e9:.2f} GB from {len(shards)} shards, "
+                               f"{total_bytes / 1e9 / max(seconds, 1e-9):.2f} GB/s, {num_threads} threads")
+
+    with phases.run("finalize"):
+        model.tie_weights()
+        missing = [name for name, param in model.named_parameters() if param.device.type == "meta"]
+        if missing:
+            raise ValueError(f"{model_path} is missing {len(missing)} weights, e.g. {missing[:5]}")
+        if unexpected:
+            logger.warning(f"{model_path}: ignored {len(unexpected)} unexpected weights, e.g. {unexpected[:5]}")
+        # Only the buffers built during init still need moving
+        model = model.to(device)
+        model.eval()
+    phases.report(model_path)
+    return model
+
+
+def export_serving_artifact(chat_model, output_dir, max_shard_size="4GB"):
+    """Save a loaded backend's model (already in its serving dtype) and tokenizer as safetensors."""
+    backend = chat_model.model
+    if not hasattr(getattr(backend, "model", None), "save_pretrained"):
+        raise ValueError(f"Backend {chat_model.backend} has no checkpoint to export")
+    backend.model.save_pretrained(output_dir, safe_serialization=True, max_shard_size=max_shard_size)
+    backend.tokenizer.save_pretrained(output_dir)
+    logger.info(f"Serving artifact written to {output_dir}")
+
+
+def shared_checkpoint(model_path, directory, backend=None, **options):
+    """
+    A serving artifact of `model_path` under `directory` (ideally a tmpfs
+    such as /dev/shm), written by the first process to get here while the
+    others wait on a file lock. Returns `(artifact_path, backend_name)` to
+    load it with.
+
+    Loading the artifact on the CPU keeps the weights mapped from its files,
+    so every worker that loads it maps the same pages instead of holding
+    its own copy. The mapping is private copy-on-write, so a worker that
+    writes to a weight only copies that page. `options` are the backend
+    options used to build the model for the export, e.g. the device policy,
+    whose dtype becomes the artifact's.
+    """
+    from app.core.minicpm.minicpm_v import MiniCPMVChat
+
+    policy = options.get("policy")
+    dtype = str(policy.dtype).replace("torch.", "") if policy is not None and policy.dtype else "auto"
+    path = os.path.join(directory, re.sub(r"[^\w.-]+", "_", model_path.strip("/")) + f"-{backend or 'auto'}-{dtype}")
+    marker = os.path.join(path, "serving_artifact.json")
+    os.makedirs(directory, exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(marker):
+            logger.info(f"Exporting {model_path} to {path} for the other workers to share")
+            chat_model = MiniCPMVChat(model_path, backend=backend, **options)
+            export_serving_artifact(chat_model, path)
+            # Backends that build their model in memory (tiny-omnilmm) name the backend that loads it from disk
+            info = {"source": model_path,
+                    "backend": getattr(chat_model.model, "artifact_backend", chat_model.backend)}
+            del chat_model
+            gc.collect()
+            # Written last, so an export cut short is redone rather than used
+            with open(marker + ".tmp", "w") as f:
+                json.dump(info, f)
+            os.replace(marker + ".tmp", marker)
+        with open(marker) as f:
+            info = json.load(f)
+    return path, info["backend"]
+
+
+def main(argv=None):
+    from app.core.backends import parse_dtype
+    from app.core.device import DevicePolicy
+    from app.core.minicpm.minicpm_v import MiniCPMVChat
+
+    parser = argparse.ArgumentParser(description="Write a pre-cast serving checkpoint.")
+    parser.add_argument("model_path")
+    parser.add_argument("output_dir")
+    parser.add_argument("--backend", help="registered backend name, for paths that do not name the model")
+    parser.add_argument("--dtype", required=True, help="serving dtype, e.g. float16 or bfloat16")
+    parser.add_argument("--device", default="cpu", help="device to load on while converting")
+    parser.add_argument("--max-shard-size", default="4GB")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    chat_model = MiniCPMVChat(args.model_path, backend=args.backend,
+                              policy=DevicePolicy(device=args.device, dtype=parse_dtype(args.dtype)))
+    export_serving_artifact(chat_model, args.output_dir, max_shard_size=args.max_shard_size)
+
+
+if __name__ == "__main__":
+    main()
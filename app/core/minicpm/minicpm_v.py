@@ -4,16 +4,37 @@ import torch
 import json
 from PIL import Image
 import base64
+import contextvars
+import functools
 import io
+import threading
+from contextlib import contextmanager
 from accelerate import load_checkpoint_and_dispatch, init_empty_weights
-from transformers import AutoTokenizer, AutoModel
+from transformers import AutoTokenizer, AutoModel, StoppingCriteriaList
 
 from app.api.v1.models.chat_completions import ChatCompletionsRequest, ChatMessage
+from app.core import tracing
+from app.core.backends import create_backend, register_backend
+from app.core.device import DevicePolicy
+from app.core.usage import Usage
+from app.core.image_decode import ImageDecoder
+from app.core.image_fetch import ImageFetchError
+from app.core.log import MessagesSummary
+from app.core.metrics import image_decode_seconds, timed, vision_encode_seconds
 
 from .omnilmm.utils import disable_torch_init
 from .omnilmm.model.omnilmm import OmniLMMForCausalLM
 from .omnilmm.model.utils import build_transform
 from .omnilmm.train.train_utils import omni_preprocess
+from .scheduler import ContinuousBatchingScheduler
+from .prefix_cache import RadixPrefixCache
+from .vision_cache import VisionEmbeddingCache, image_key
+from .stopping import (
+    CancelledCriteria, StopSequenceCriteria, StopStringFilter, normalize_stop, truncate_at_stop,
+)
+from .detokenizer import TokenCounter, TokenStreamer
+from .fast_load import load_pretrained
+from .quantize import quantize_model
 
 import logging
 
@@ -26,8 +47,7 @@ DEFAULT_IM_END_TOKEN = "<im_end>"
 
     
 
-def init_omni_lmm(model_path):
-    torch.backends.cuda.matmul.allow_tf32 = True
+def init_omni_lmm(model_path, device='cuda', dtype=torch.bfloat16, load_threads=8):
     disable_torch_init()
     model_name = os.path.expanduser(model_path)
     print(f'Load omni_lmm model and tokenizer from {model_name}')
@@ -42,10 +62,14 @@ def init_omni_lmm(model_path):
                     device_map="auto",  no_split_module_classes=['Eva','MistralDecoderLayer', 'ModuleList', 'Resampler']
         )
     else:
-        model = OmniLMMForCausalLM.from_pretrained(
-            model_name, tune_clip=True, torch_dtype=torch.bfloat16
-        ).to(device='cuda', dtype=torch.bfloat16)
+        model = load_pretrained(
+            OmniLMMForCausalLM, model_name, dtype, device, num_threads=load_threads, tune_clip=True)
 
+    return (model,) + setup_omni_lmm(model, tokenizer)
+
+
+def setup_omni_lmm(model, tokenizer):
+    """Register the image tokens with the tokenizer and vision config; returns (image_processor, image_token_len, tokenizer)."""
     image_processor = build_transform(
         is_train=False, input_size=model.model.config.image_size, std_mode='OPENAI_CLIP')
 
@@ -64,7 +88,7 @@ def init_omni_lmm(model_path):
         [DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN])
     image_token_len = model.model.config.num_query
 
-    return model, image_processor, image_token_len, tokenizer
+    return image_processor, image_token_len, tokenizer
 
 def expand_question_into_multimodal(question_text, image_token_len, im_st_token, im_ed_token, im_patch_token):
     if '<image>' in question_text[0]['content']:
@@ -75,9 +99,10 @@ def expand_question_into_multimodal(question_text, image_token_len, im_st_token,
             image_token_len + im_ed_token + '\n' + question_text[0]['content']
     return question_text
 
-def wrap_question_for_omni_lmm(question, image_token_len, tokenizer):
-    question = expand_question_into_multimodal(
-        question, image_token_len, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN, DEFAULT_IMAGE_PATCH_TOKEN)
+def wrap_question_for_omni_lmm(question, image_token_len, tokenizer, with_image=True):
+    if with_image:
+        question = expand_question_into_multimodal(
+            question, image_token_len, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN, DEFAULT_IMAGE_PATCH_TOKEN)
 
     conversation = question
     data_dict = omni_preprocess(sources=[conversation],
@@ -90,22 +115,253 @@ def wrap_question_for_omni_lmm(question, image_token_len, tokenizer):
 
 
 
+def omni_lmm_input(request):
+    """
+    OmniLMM `chat()` input from a chat completions request: the first image
+    of the conversation and the text turns as a JSON question. OmniLMM's
+    prompt has no system turn, so a system message is prepended to the first
+    user turn.
+    """
+    image = None
+    system = []
+    msgs = []
+    for message in request.messages:
+        if isinstance(message.content, str):
+            text = message.content
+        else:
+            texts = []
+            for item in message.content:
+                if isinstance(item, str):
+                    texts.append(item)
+                elif isinstance(item, dict) and item.get('type') == "text":
+                    texts.append(item['text'])
+                elif isinstance(item, dict) and item.get('type') == "image_url" and image is None:
+                    url = item.get('image_url', {}).get('url', '')
+                    if url.startswith(("http://", "https://")):
+                        image = request.remote_image(url)
+                        if image is None:
+                            raise ImageFetchError(f"Image {url} was not fetched")
+                    else:
+                        image = url.split(',', 1)[-1]
+            text = '\n'.join(texts)
+        if message.role == "system":
+            system.append(text)
+        else:
+            msgs.append({"role": message.role, "content": text})
+    if system and msgs:
+        msgs[0]["content"] = '\n'.join(system + [msgs[0]["content"]])
+    return {
+        'image': image,
+        'question': json.dumps(msgs, ensure_ascii=False),
+        'stream': request.stream,
+        'stop': request.stop,
+        'max_tokens': request.max_tokens,
+    }
+
+
+def attach_scheduler(llm, max_batch_size, prefix_cache_bytes=0, policy=None, cache_answers=True):
+    """Serve `llm.generate` from a shared continuous batch when batching is enabled."""
+    if max_batch_size <= 0:
+        return None
+    prefix_cache = RadixPrefixCache(prefix_cache_bytes) if prefix_cache_bytes > 0 else None
+    scheduler = ContinuousBatchingScheduler(llm, max_batch_size=max_batch_size, prefix_cache=prefix_cache,
+                                            policy=policy, cache_answers=cache_answers)
+    scheduler.attach()
+    logger.info(f"Continuous batching enabled for {type(llm).__name__} "
+                f"(max_batch_size={max_batch_size}, prefix_cache_bytes={prefix_cache_bytes})")
+    return scheduler
+
+
+def stop_criteria(stop, tokenizer, cancelled=None):
+    """Criteria for `request.stop` and for `cancelled`, the event set when the client goes away."""
+    criteria = []
+    if stop:
+        criteria.append(StopSequenceCriteria(stop, tokenizer))
+    if cancelled is not None:
+        criteria.append(CancelledCriteria(cancelled))
+    return StoppingCriteriaList(criteria) if criteria else None
+
+
+def apply_stop_to_stream(chunks, stop):
+    """Truncate a stream of text chunks at the first stop string."""
+    stop_filter = StopStringFilter(stop)
+    for text in chunks:
+        text, stopped = stop_filter.feed(text)
+        if text:
+            yield text
+        if stopped:
+            return
+    tail = stop_filter.flush()
+    if tail:
+        yield tail
+
+
+class RemoteDecodeHook:
+    """
+    Takes over the decode step of a remote MiniCPM-V model.
+
+    The remote `chat()` only forwards a fixed set of sampling options, so
+    per-request extras (e.g. stopping criteria) are injected into its
+    `_decode` helper. `_decode_stream` is replaced outright so streaming goes
+    through a TokenStreamer rather than `TextIteratorStreamer`. Both helpers
+    run on the thread that called `chat()`, which is where `use()` sets the
+    extras and the Usage the token counts are recorded into.
+    """
+
+    def __init__(self, model, policy):
+        self.model = model
+        self.policy = policy
+        self._local = threading.local()
+        original = getattr(model, '_decode', None)
+        if original is not None:
+            model._decode = self._wrap(original)
+        if hasattr(model, '_decode_stream'):
+            model._decode_stream = self._decode_stream
+
+    def _extra_kwargs(self):
+        return getattr(self._local, 'kwargs', None) or {}
+
+    def _usage(self, inputs_embeds):
+        usage = getattr(self._local, 'usage', None)
+        if usage is not None:
+            # The embeddings already have the image features spliced in
+            usage.start_generation(inputs_embeds.shape[1])
+        return usage
+
+    def _wrap(self, original):
+        def decode(inputs_embeds, tokenizer, **kwargs):
+            kwargs.update(self._extra_kwargs())
+            usage = self._usage(inputs_embeds)
+            if usage is not None:
+                kwargs['streamer'] = TokenCounter(usage)
+            return original(inputs_embeds, tokenizer, **kwargs)
+        return decode
+
+    def _decode_stream(self, inputs_embeds, tokenizer, **kwargs):
+        kwargs.update(self._extra_kwargs())
+        usage = self._usage(inputs_embeds)
+        terminators = [tokenizer.eos_token_id]
+        # Llama 3 ends a turn with <|eot_id|> rather than the eos token
+        eot_id = tokenizer.convert_tokens_to_ids('<|eot_id|>')
+        if eot_id is not None and eot_id != tokenizer.unk_token_id:
+            terminators.append(eot_id)
+
+        streamer = TokenStreamer(tokenizer, usage=usage)
+        generation_kwargs = {
+            'inputs_embeds': inputs_embeds,
+            'pad_token_id': 0,
+            'eos_token_id': terminators,
+            'streamer': streamer,
+        }
+        generation_kwargs.update(kwargs)
+        # The generate thread runs in a copy of this context so it records into the request's trace
+        thread = threading.Thread(
+            target=contextvars.copy_context().run, args=(self._generate_to_streamer, generation_kwargs),
+            daemon=True)
+        thread.start()
+        return streamer
+
+    def _generate_to_streamer(self, generation_kwargs):
+        error = None
+        try:
+            self.policy.run(self.model.llm.generate, **generation_kwargs)
+        except Exception as e:
+            logger.exception("streaming decode failed")
+            error = e
+        finally:
+            # A stream that is never ended blocks its consumer, and with it the inference worker
+            generation_kwargs['streamer'].end(error)
+
+    @contextmanager
+    def use(self, usage=None, **kwargs):
+        self._local.kwargs = {k: v for k, v in kwargs.items() if v is not None}
+        self._local.usage = usage
+        try:
+            yield
+        finally:
+            self._local.kwargs = None
+            self._local.usage = None
+
+
+def instrument(backend, embedding_model=None):
+    """Time a backend's image decoding and prompt embedding for /metrics and request traces."""
+    name = type(backend).__name__
+    backend.decode_images = tracing.traced(
+        timed(backend.image_decoder.decode_many, image_decode_seconds.labels(name)), "image.decode")
+    if embedding_model is None:
+        return
+    # CUDA kernels run asynchronously; synchronize so the GPU work is timed, not just its launch
+    policy = getattr(backend, "policy", None)
+    synchronize = None
+    if policy is not None and policy.device_type == "cuda":
+        synchronize = functools.partial(torch.cuda.synchronize, policy.device)
+    embedding_model.get_vllm_embedding = tracing.traced(
+        timed(embedding_model.get_vllm_embedding, vision_encode_seconds.labels(name), synchronize), "embed")
+
+
+def create_vision_cache(max_bytes):
+    if max_bytes <= 0:
+        return None
+    logger.info(f"Vision embedding cache enabled ({max_bytes} bytes)")
+    return VisionEmbeddingCache(max_bytes)
+
+
 class OmniLMM12B:
-    def __init__(self, model_path) -> None:
-        model, img_processor, image_token_len, tokenizer = init_omni_lmm(model_path)
+    # Linear layers replaced by `quantization` (see quantize.py)
+    QUANTIZED_MODULES = (
+        r"^model\.layers\.\d+\.",
+        r"^model\.resampler\.kv_proj$",
+        r"^model\.vision_tower\.blocks\.\d+\.mlp\.",
+    )
+
+    def __init__(self, model_path, max_batch_size=0, vision_cache_bytes=0, prefix_cache_bytes=0,
+                 image_decoder=None, policy=None, load_threads=8, quantization=None, vision_batch_size=8) -> None:
+        self.policy = (policy or DevicePolicy()).configure(torch.bfloat16)
+        self.load_threads = load_threads
+        model, img_processor, image_token_len, tokenizer = self.load(model_path)
+        if quantization:
+            quantize_model(model, quantization, self.QUANTIZED_MODULES)
+        # Most images the vision tower encodes in one forward pass
+        model.model.vision_batch_size = vision_batch_size
         self.model = model
+        self.image_decoder = image_decoder or ImageDecoder()
+        instrument(self, model.model)
+        # The transform resizes straight to this square, so nothing larger is decoded
+        self.image_size = (model.model.config.image_size, model.model.config.image_size)
         self.image_token_len = image_token_len
         self.image_transform = img_processor
         self.tokenizer = tokenizer
         self.model.eval()
-
-    def decode(self, image, input_ids):
-        with torch.inference_mode():
-            output = self.model.generate_vllm(
-                input_ids=input_ids.unsqueeze(0).cuda(),
-                images=image.unsqueeze(0).half().cuda(),
+        self.scheduler = attach_scheduler(self.model, max_batch_size, prefix_cache_bytes, self.policy)
+        self.vision_cache = create_vision_cache(vision_cache_bytes)
+
+    def load(self, model_path):
+        """Returns (model, image_processor, image_token_len, tokenizer)."""
+        return init_omni_lmm(model_path, device=self.policy.device, dtype=self.policy.dtype,
+                             load_threads=self.load_threads)
+
+    def decode(self, image, input_ids, vision_hidden_states=None, stop=None, streamer=None, usage=None,
+               max_new_tokens=1024, cancelled=None):
+        if usage is not None:
+            # input_ids already holds a placeholder for every image query token
+            usage.start_generation(input_ids.shape[0])
+        kwargs = {}
+        criteria = stop_criteria(stop, self.tokenizer, cancelled)
+        if criteria is not None:
+            kwargs['stopping_criteria'] = criteria
+        if streamer is None and usage is not None:
+            streamer = TokenCounter(usage)
+        if streamer is not None:
+            kwargs['streamer'] = streamer
+        device = self.model.device
+        with self.policy.inference():
+            output, vision_hidden_states = self.model.generate_vllm(
+                input_ids=input_ids.unsqueeze(0).to(device),
+                images=image.unsqueeze(0).to(device=device, dtype=self.model.dtype) if image is not None else None,
+                vision_hidden_states=vision_hidden_states,
+                return_vision_hidden_states=True,
                 temperature=0.6,
-                max_new_tokens=1024,
+                max_new_tokens=max_new_tokens,
                 # num_beams=num_beams,
                 do_sample=True,
                 output_scores=True,
@@ -113,27 +369,73 @@ class OmniLMM12B:
                 repetition_penalty=1.1,
                 top_k=30,
                 top_p=0.9,
+                **kwargs
             )
 
             response = self.tokenizer.decode(
                 output.sequences[0], skip_special_tokens=True)
+            if stop:
+                response = truncate_at_stop(response, stop)
             response = response.strip()
-            return response
+            return response, vision_hidden_states
 
-    def chat(self, input):
+    def _decode_to_streamer(self, streamer, key, image, input_ids, vision_hidden_states, stop, usage,
+                            max_new_tokens, cancelled):
         try:
-            image = Image.open(io.BytesIO(base64.b64decode(input['image']))).convert('RGB')
+            _, vision_hidden_states = self.decode(
+                image, input_ids, vision_hidden_states=vision_hidden_states, stop=stop,
+                streamer=streamer, usage=usage, max_new_tokens=max_new_tokens, cancelled=cancelled)
         except Exception as e:
-            return "Image decode error"
+            logger.exception("streaming decode failed")
+            streamer.end(e)
+            return
+        if key is not None:
+            self.vision_cache.put(key, vision_hidden_states[0])
+
+    def chat(self, input, usage=None, cancelled=None):
+        if isinstance(input, ChatCompletionsRequest):
+            input = omni_lmm_input(input)
+        max_new_tokens = input.get('max_tokens') or 1024
+        # Without an image the prompt gets no image tokens and the vision tower is skipped
+        has_image = bool(input.get('image'))
+        key = image_key(input['image']) if has_image and self.vision_cache is not None else None
+        cached = self.vision_cache.get(key) if key is not None else None
+
+        # A cache hit skips both the base64/PIL decode and the vision tower
+        image = None
+        if has_image and cached is None:
+            image = self.decode_images([input['image']], min_size=self.image_size)[0]
+            with tracing.span("image.transform"):
+                image = self.image_transform(image)
 
         msgs = json.loads(input['question'])
-        input_ids = wrap_question_for_omni_lmm(
-            msgs, self.image_token_len, self.tokenizer)['input_ids']
-        input_ids = torch.as_tensor(input_ids)
+        with tracing.span("tokenize"):
+            input_ids = wrap_question_for_omni_lmm(
+                msgs, self.image_token_len, self.tokenizer, with_image=has_image)['input_ids']
+            input_ids = torch.as_tensor(input_ids)
         #print('input_ids', input_ids)
-        image = self.image_transform(image)
 
-        out = self.decode(image, input_ids)
+        stop = normalize_stop(input.get('stop'))
+        if cached is not None:
+            vision_hidden_states = [cached]
+        else:
+            vision_hidden_states = None if has_image else []
+
+        if input.get('stream'):
+            streamer = TokenStreamer(self.tokenizer, usage=usage)
+            threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(self._decode_to_streamer, streamer, key if cached is None else None, image, input_ids,
+                      vision_hidden_states, stop, usage, max_new_tokens, cancelled),
+                daemon=True,
+            ).start()
+            return apply_stop_to_stream(streamer, stop) if stop else streamer
+
+        out, vision_hidden_states = self.decode(
+            image, input_ids, vision_hidden_states=vision_hidden_states, stop=stop, usage=usage,
+            max_new_tokens=max_new_tokens, cancelled=cancelled)
+        if key is not None and cached is None:
+            self.vision_cache.put(key, vision_hidden_states[0])
 
         return out
         
@@ -148,44 +450,188 @@ def _create_blank_image():
     blank_image = Image.new('RGB', (100, 100), (255, 255, 255))  # White 100x100 image
     return blank_image
 
+def slice_area(config):
+    """Pixel area MiniCPM-V slices an image into, so nothing larger needs decoding."""
+    slice_config = getattr(config, 'slice_config', None) or config
+    if isinstance(slice_config, dict):
+        scale_resolution = slice_config.get('scale_resolution', 448)
+        max_slice_nums = slice_config.get('max_slice_nums', 9)
+    else:
+        scale_resolution = getattr(slice_config, 'scale_resolution', 448)
+        max_slice_nums = getattr(slice_config, 'max_slice_nums', 9)
+    return scale_resolution * scale_resolution * max_slice_nums
+
+
 class MiniCPMV:
-    def __init__(self, model_path) -> None:
-        self.model = AutoModel.from_pretrained(model_path, trust_remote_code=True).to(dtype=torch.bfloat16)
+    QUANTIZED_MODULES = (
+        r"^llm\.model\.layers\.\d+\.",
+        r"^resampler\.kv_proj$",
+        r"^vpm\.blocks\.\d+\.mlp\.",
+    )
+
+    def __init__(self, model_path, max_batch_size=0, prefix_cache_bytes=0, image_decoder=None,
+                 policy=None, load_threads=8, quantization=None) -> None:
+        self.policy = (policy or DevicePolicy()).configure(torch.bfloat16)
+        self.model = load_pretrained(AutoModel, model_path, self.policy.dtype, self.policy.device,
+                                     num_threads=load_threads, trust_remote_code=True)
+        if quantization:
+            quantize_model(self.model, quantization, self.QUANTIZED_MODULES)
         self.tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
-        self.model.eval().cuda()
-
-    def chat(self, input):
-        try:            
-            image = Image.open(io.BytesIO(base64.b64decode(input['image']))).convert('RGB')
-        except Exception as e:
-            return "Image decode error"
+        self.image_decoder = image_decoder or ImageDecoder()
+        self.image_area = slice_area(self.model.config)
+        instrument(self, self.model)
+        # Prompt embeddings are multiplied by `scale_emb`, so answers keyed by the
+        # plain token embeddings would never match a later prompt
+        self.scheduler = attach_scheduler(self.model.llm, max_batch_size, prefix_cache_bytes, self.policy,
+                                          cache_answers=False)
+        self.decode_hook = RemoteDecodeHook(self.model, self.policy)
+        # The remote chat() needs an image, so text-only requests get a blank
+        # one whose vision embedding is computed once and then reused
+        self._blank_image = _create_blank_image()
+        self._blank_vision_hidden_states = None
+        self._vision_capture = threading.local()
+        self._get_vllm_embedding = self.model.get_vllm_embedding
+        self.model.get_vllm_embedding = self._capture_vllm_embedding
+
+    def _capture_vllm_embedding(self, data):
+        inputs_embeds, vision_hidden_states = self._get_vllm_embedding(data)
+        self._vision_capture.value = vision_hidden_states
+        return inputs_embeds, vision_hidden_states
+
+    def chat(self, input, usage=None, cancelled=None):
+        # The remote chat() takes one image and the text turns, like OmniLMM's
+        if isinstance(input, ChatCompletionsRequest):
+            input = omni_lmm_input(input)
+        vision_hidden_states = None
+        if input.get('image'):
+            image = self.decode_images([input['image']], min_area=self.image_area)[0]
+        else:
+            image = self._blank_image
+            if self._blank_vision_hidden_states is not None:
+                vision_hidden_states = [self._blank_vision_hidden_states]
+            self._vision_capture.value = None
 
         msgs = json.loads(input['question'])
-        
-        answer, context, _ = self.model.chat(
-            image=image,
-            msgs=msgs,
-            context=None,
-            tokenizer=self.tokenizer,
-            sampling=True,
-            temperature=0.7
-    	)
+        stop = normalize_stop(input.get('stop'))
+
+        with self.decode_hook.use(usage=usage, stopping_criteria=stop_criteria(stop, self.tokenizer, cancelled)), \
+                self.policy.inference():
+            answer, context, _ = self.model.chat(
+                image=image,
+                msgs=msgs,
+                context=None,
+                tokenizer=self.tokenizer,
+                vision_hidden_states=vision_hidden_states,
+                max_new_tokens=input.get('max_tokens') or 1024,
+                sampling=True,
+                temperature=0.7
+            )
+        if image is self._blank_image and vision_hidden_states is None and self._vision_capture.value is not None:
+            self._blank_vision_hidden_states = self._vision_capture.value[0]
+        if stop:
+            answer = truncate_at_stop(answer, stop)
         return answer
 
+def _message_text(content):
+    """
+    Text of a message's content: a string, or a list holding strings (user
+    turns, already processed) and OpenAI `{"type": "text"}` parts (any
+    other role, passed through as sent).
+    """
+    if isinstance(content, str):
+        return content
+    texts = []
+    for item in content:
+        if isinstance(item, str):
+            texts.append(item)
+        elif isinstance(item, dict) and item.get('type') == "text":
+            texts.append(item['text'])
+    return '\n'.join(texts)
+
+
+# What the remote chat() samples with when `sampling=True`
+TEXT_GENERATION_CONFIG = {
+    'top_p': 0.8,
+    'top_k': 100,
+    'temperature': 0.7,
+    'do_sample': True,
+    'repetition_penalty': 1.05,
+}
+
+
 class MiniCPMV2_5:
-    def __init__(self, model_path) -> None:
-        self.model = AutoModel.from_pretrained(model_path, trust_remote_code=True).to(dtype=torch.float16)
+    # The SigLIP vision tower keeps its blocks in encoder.layers
+    QUANTIZED_MODULES = (
+        r"^llm\.model\.layers\.\d+\.",
+        r"^resampler\.kv_proj$",
+        r"^vpm\.encoder\.layers\.\d+\.mlp\.",
+    )
+
+    def __init__(self, model_path, max_batch_size=0, vision_cache_bytes=0, prefix_cache_bytes=0,
+                 image_decoder=None, policy=None, load_threads=8, quantization=None) -> None:
+        self.policy = (policy or DevicePolicy()).configure(torch.float16)
+        self.model = load_pretrained(AutoModel, model_path, self.policy.dtype, self.policy.device,
+                                     num_threads=load_threads, trust_remote_code=True)
+        if quantization:
+            quantize_model(self.model, quantization, self.QUANTIZED_MODULES)
         self.tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
-        self.model.eval().cuda()
-
-    def chat(self, input: ChatCompletionsRequest):
+        self.image_decoder = image_decoder or ImageDecoder()
+        self.image_area = slice_area(self.model.config)
+        instrument(self, self.model)
+        self.scheduler = attach_scheduler(self.model.llm, max_batch_size, prefix_cache_bytes, self.policy)
+        self.vision_cache = create_vision_cache(vision_cache_bytes)
+        self.decode_hook = RemoteDecodeHook(self.model, self.policy)
+        if self.vision_cache is not None:
+            # Capture the resampler output the remote chat() computes so it can be cached
+            self._vision_capture = threading.local()
+            self._get_vllm_embedding = self.model.get_vllm_embedding
+            self.model.get_vllm_embedding = self._capture_vllm_embedding
+
+    def _capture_vllm_embedding(self, data):
+        inputs_embeds, vision_hidden_states = self._get_vllm_embedding(data)
+        self._vision_capture.value = vision_hidden_states
+        return inputs_embeds, vision_hidden_states
+
+    def _chat_text(self, msgs, system_prompt, input):
+        """
+        Text-only chat straight on the language model, with the same prompt
+        format and sampling defaults as the remote `chat()`. The remote
+        `chat()` expects an image, so text requests used to get a blank image
+        that was sliced and run through the vision tower every time.
+        """
+        if system_prompt:
+            msgs = [{'role': 'system', 'content': system_prompt}] + msgs
+        msgs = [{'role': msg['role'], 'content': _message_text(msg['content'])} for msg in msgs]
+        with tracing.span("tokenize"):
+            prompt = self.tokenizer.apply_chat_template(msgs, tokenize=False, add_generation_prompt=True)
+            # The chat template already starts with <|begin_of_text|>
+            input_ids = self.tokenizer(prompt, return_tensors='pt', add_special_tokens=False).input_ids
+
+        generation_config = dict(
+            TEXT_GENERATION_CONFIG,
+            max_new_tokens=input.max_tokens,
+            temperature=input.temperature,
+            repetition_penalty=input.repetition_penalty,
+        )
+        embed_tokens = self.model.llm.get_input_embeddings()
+        with self.policy.inference():
+            inputs_embeds = embed_tokens(input_ids.to(embed_tokens.weight.device))
+            if input.stream:
+                return self.model._decode_stream(inputs_embeds, self.tokenizer, **generation_config)
+            return self.model._decode(inputs_embeds, self.tokenizer, decode_text=True, **generation_config)[0]
+
+    def chat(self, input: ChatCompletionsRequest, usage=None, cancelled=None):
         # try:            
         #     image = Image.open(io.BytesIO(base64.b64decode(input.image))).convert('RGB')
         # except Exception as e:
         #     logger.error(f"Image decode error: {e}") 
-        logger.info(f"request: {input}")
+        logger.debug("request: %s", MessagesSummary(input.messages),
+                     extra={"stream": input.stream, "max_tokens": input.max_tokens})
 
         processed_messages = []
+        image_keys = []
+        image_payloads = []
+        image_slots = []
         has_image_in_all_messages = False
 
         # First pass to check if any image exists
@@ -198,7 +644,7 @@ class MiniCPMV2_5:
             if has_image_in_all_messages:
                 break
         
-        logger.info(f"has_image_in_all_messages: {has_image_in_all_messages}")
+        logger.debug("has_image_in_all_messages: %s", has_image_in_all_messages)
         user_message_index = None
         for idx, message in enumerate(input.messages):
             if message.role == "user":
@@ -218,21 +664,30 @@ class MiniCPMV2_5:
                                     url = image_url['url']
                                     splitted_url = url.split(',', 1)
                                     if splitted_url[0].startswith("data:image/"):
-                                        image = Image.open(io.BytesIO(base64.b64decode(splitted_url[1]))).convert('RGB')
-                                        processed_content.append(image)
+                                        if self.vision_cache is not None:
+                                            image_keys.append(image_key(splitted_url[1]))
+                                        # Decoded together below; keep the slot so message order is preserved
+                                        image_payloads.append(splitted_url[1])
+                                        image_slots.append((processed_content, len(processed_content)))
+                                        processed_content.append(None)
+                                    elif url.startswith(("http://", "https://")):
+                                        data = input.remote_image(url)
+                                        if data is None:
+                                            raise ImageFetchError(f"Image {url} was not fetched")
+                                        if self.vision_cache is not None:
+                                            image_keys.append(image_key(data))
+                                        image_payloads.append(data)
+                                        image_slots.append((processed_content, len(processed_content)))
+                                        processed_content.append(None)
                     processed_messages.append({"role": "user", "content": processed_content})
             else:
                 processed_messages.append({"role": message.role, "content": message.content})
 
-        # If no image in all messages, add a blank image to the first user message
-        if not has_image_in_all_messages and user_message_index is not None:
-            blank_image = _create_blank_image()
-            if isinstance(processed_messages[0]["content"], list):
-                processed_messages[user_message_index]["content"].append(blank_image)
-            else:
-                processed_messages[user_message_index]["content"] = [processed_messages[user_message_index]["content"], blank_image]
+        images = self.decode_images(image_payloads, min_area=self.image_area) if image_payloads else []
+        for (content, index), image in zip(image_slots, images):
+            content[index] = image
 
-        logger.info(f"processed_message: {processed_messages}")
+        logger.debug("processed_message: %s", MessagesSummary(processed_messages))
         if processed_messages[0]['role'] == "system":
             system_prompt = processed_messages[0]['content']
             processed_messages = processed_messages[1:]
@@ -241,33 +696,75 @@ class MiniCPMV2_5:
     
         #msgs = json.dumps([message.dict() for message in processed_messages])
         
-        logger.info(f"system_prompt: {system_prompt}")
-
-        answer = self.model.chat(
-            image=None,
-            msgs=processed_messages,
-            tokenizer=self.tokenizer,
-            sampling=True,
-            max_new_tokens=input.max_tokens,
-            temperature=input.temperature,
-            repetition_penalty=input.repetition_penalty,
-            stream=input.stream,
-            system_prompt=system_prompt
-    	)
+        logger.debug("system_prompt: %s chars", len(system_prompt))
+
+        # Slices of every image in the request are encoded together, so the
+        # cached entry covers the whole ordered set of images.
+        cache_key = '|'.join(image_keys) if image_keys else None
+        cached = self.vision_cache.get(cache_key) if cache_key is not None else None
+        if cache_key is not None:
+            self._vision_capture.value = None
+
+        stop = normalize_stop(input.stop)
+        with self.decode_hook.use(usage=usage, stopping_criteria=stop_criteria(stop, self.tokenizer, cancelled)), \
+                self.policy.inference():
+            if not has_image_in_all_messages:
+                answer = self._chat_text(processed_messages, system_prompt, input)
+            else:
+                answer = self.model.chat(
+                    image=None,
+                    msgs=processed_messages,
+                    tokenizer=self.tokenizer,
+                    vision_hidden_states=[cached] if cached is not None else None,
+                    sampling=True,
+                    max_new_tokens=input.max_tokens,
+                    temperature=input.temperature,
+                    repetition_penalty=input.repetition_penalty,
+                    stream=input.stream,
+                    system_prompt=system_prompt
+                )
+        if cache_key is not None and cached is None and self._vision_capture.value is not None:
+            self.vision_cache.put(cache_key, self._vision_capture.value[0])
+        if stop:
+            # Generation stops at the token that completes a stop string; the
+            # text itself still has to be cut where the stop string begins.
+            if input.stream:
+                answer = apply_stop_to_stream(answer, stop)
+            else:
+                answer = truncate_at_stop(answer, stop)
         return answer
 
 
-class MiniCPMVChat:
-    def __init__(self, model_path) -> None:
-        if '12B' in model_path:
-            self.model = OmniLMM12B(model_path)
-        elif 'MiniCPM-Llama3-V' in model_path:
-            self.model = MiniCPMV2_5(model_path)
-        else:
-            self.model = MiniCPMV(model_path)
+register_backend('omnilmm-12b', OmniLMM12B, match=lambda model_id: '12B' in model_id)
+register_backend('minicpm-llama3-v-2.5', MiniCPMV2_5, match=lambda model_id: 'MiniCPM-Llama3-V' in model_id)
+register_backend('minicpm-v-2', MiniCPMV, match=lambda model_id: 'MiniCPM-V' in model_id)
+register_backend('tiny-omnilmm', 'app.core.minicpm.tiny:TinyOmniLMM')
+register_backend('stub', 'app.core.minicpm.tiny:FakeChat')
 
-    def chat(self, input):
-        return self.model.chat(input)
+
+class MiniCPMVChat:
+    def __init__(self, model_path, backend=None, **options) -> None:
+        """
+        Serve `model_path` with the registered backend that claims it, or the
+        one named `backend`. `options` (max_batch_size, cache sizes,
+        image_decoder, policy, ...) are passed on where supported.
+        """
+        self.backend, self.model = create_backend(model_path, backend, **options)
+
+    def chat(self, input, usage=None, cancelled=None):
+        """
+        Run one request; token counts are recorded into `usage` when given.
+        Generation stops early once `cancelled` (a `threading.Event`) is set.
+        """
+        return self.model.chat(input, usage=usage, cancelled=cancelled)
+
+    def warm_up(self):
+        """Run one short text request so lazy initialization (kernels, caches) happens before traffic."""
+        request = ChatCompletionsRequest(messages=[ChatMessage(role="user", content="Hello")], max_tokens=4)
+        answer = self.chat(request, usage=Usage())
+        if not isinstance(answer, str):
+            for _ in answer:
+                pass
 
 
 if __name__ == '__main__':
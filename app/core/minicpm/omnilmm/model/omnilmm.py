@@ -12,6 +12,7 @@ from transformers import AutoConfig, AutoModelForCausalLM
 from transformers import MistralForCausalLM, MistralModel, MistralConfig
 from transformers.modeling_outputs import BaseModelOutputWithPast, CausalLMOutputWithPast
 
+from app.core import tracing
 from app.core.minicpm.omnilmm.model.utils import build_transform
 from app.core.minicpm.omnilmm.model.resampler import Resampler
 
@@ -30,11 +31,14 @@ class Identity(torch.nn.Identity):
 
 
 def create_vision_module(config):
-    vision_tower = timm.create_model('eva02_enormous_patch14_clip_224.laion2b_plus',
+    # Checkpoints use EVA02-enormous; the tiny test model names a smaller timm
+    # architecture and overrides its size (depth, img_size, ...) in the config
+    vision_tower = timm.create_model(getattr(config, 'vision_tower_name', 'eva02_enormous_patch14_clip_224.laion2b_plus'),
                                      pretrained=False,
                                      num_classes=0,
                                      dynamic_img_size=True,
-                                     dynamic_img_pad=True)
+                                     dynamic_img_pad=True,
+                                     **getattr(config, 'vision_tower_kwargs', {}))
 
     if isinstance(vision_tower, timm.models.VisionTransformer):
         if vision_tower.attn_pool is not None:
@@ -71,6 +75,8 @@ class OmniLMMModel(MistralModel):
                 self.vision_tower = self.vision_tower[0]
 
         self.vision_config = lambda x: None
+        # Max number of images per vision tower forward pass
+        self.vision_batch_size = getattr(config, 'vision_batch_size', 8)
 
     def initialize_vision_modules(self, vision_tower, no_randaug, num_query, image_size, tune_clip=False):
         self.config.mm_vision_tower = vision_tower
@@ -120,18 +126,76 @@ class OmniLMMModel(MistralModel):
         res = self.resampler(vision_embedding)
         return res
 
+    def get_vision_embeddings(self, pixel_values_list):
+        """
+        Encode a list of images (empty entries mean "no image") in batched
+        forward passes of at most `vision_batch_size` images, keeping the
+        results in input order.
+        """
+        vision_hidden_states = [[] for _ in range(len(pixel_values_list))]
+        groups = {}
+        for idx, pixel_values in enumerate(pixel_values_list):
+            if len(pixel_values) > 0:
+                # Only images of the same size can share a forward pass
+                groups.setdefault(tuple(pixel_values.shape), []).append(idx)
+
+        for indices in groups.values():
+            for start in range(0, len(indices), self.vision_batch_size):
+                chunk = indices[start:start + self.vision_batch_size]
+                with tracing.span("vision.encode", images=len(chunk)):
+                    pixel_values = torch.stack([pixel_values_list[idx] for idx in chunk])
+                    for idx, embedding in zip(chunk, self.get_vision_embedding(pixel_values)):
+                        vision_hidden_states[idx] = embedding
+        return vision_hidden_states
+
+    def splice_image_features(self, input_ids, inputs_embeds, image_features):
+        """
+        Write image features over the `<im_patch>` positions of `inputs_embeds`.
+
+        Images are consumed in order of appearance across the whole batch, so
+        `image_features` holds one `[num_query, hidden]` tensor per
+        `<im_start>` in row-major order (empty entries are skipped). Samples
+        without images are left untouched.
+        """
+        if not self.vision_config.use_im_start_end:
+            raise NotImplementedError
+        patch_mask = input_ids == self.vision_config.im_patch_token
+        if not patch_mask.any():
+            return inputs_embeds
+
+        start_mask = input_ids == self.vision_config.im_start_token
+        end_mask = input_ids == self.vision_config.im_end_token
+        if (start_mask.sum(dim=1) != end_mask.sum(dim=1)).any():
+            raise ValueError(
+                "The number of image start tokens and image end tokens should be the same.")
+
+        if isinstance(image_features, torch.Tensor):
+            image_features = image_features.flatten(0, 1)
+        else:
+            image_features = torch.cat([f for f in image_features if isinstance(f, torch.Tensor)], dim=0)
+        if image_features.shape[0] != patch_mask.sum():
+            raise ValueError(
+                f"Got {image_features.shape[0]} image feature rows for {int(patch_mask.sum())} image patch tokens.")
+
+        # HACK: replace back original embeddings for LLaVA pretraining, only the
+        # image span (start/end tokens included) keeps its gradient
+        if getattr(self, 'orig_embeds_params', None) is not None:
+            trainable = (patch_mask | start_mask | end_mask).unsqueeze(-1)
+            inputs_embeds = torch.where(trainable, inputs_embeds, inputs_embeds.detach())
+
+        return inputs_embeds.masked_scatter(
+            patch_mask.unsqueeze(-1),
+            image_features.to(device=inputs_embeds.device, dtype=inputs_embeds.dtype))
+
     def get_vllm_embedding(self, data):
 
-        if 'vision_hidden_states' not in data:
-            pixel_values_list = data['pixel_values']
+        if 'vision_hidden_states' in data:
+            vision_hidden_states = data['vision_hidden_states']
+        elif data.get('pixel_values') is None:
+            # Text-only prompt, the vision tower is not needed
             vision_hidden_states = []
-            for pixel_values in pixel_values_list:
-                if len(pixel_values) > 0:
-                    vision_hidden_states.append(self.get_vision_embedding(pixel_values.unsqueeze(0))[0])
-                else:
-                    vision_hidden_states.append([])
         else:
-            vision_hidden_states = data['vision_hidden_states']
+            vision_hidden_states = self.get_vision_embeddings(data['pixel_values'])
 
         #vllm_embedding = self.llm.model.embed_tokens(data['input_ids']) * self.llm.config.scale_emb
         inputs_embeds = self.embed_tokens(data['input_ids'])
@@ -139,45 +203,8 @@ class OmniLMMModel(MistralModel):
             if isinstance(i, torch.Tensor) else i for i in vision_hidden_states
         ]
 
-
-        # HACK: replace back original embeddings for LLaVA pretraining
-        orig_embeds_params = getattr(self, 'orig_embeds_params', None)
-
-        new_input_embeds = []
-        cur_image_idx = 0
-        for cur_input_ids, cur_input_embeds in zip(data['input_ids'], inputs_embeds):
-            if (cur_input_ids == self.vision_config.im_patch_token).sum() == 0:
-                # multimodal LLM, but the current sample is not multimodal
-                cur_input_embeds = cur_input_embeds + (0. * dummy_image_features).sum()
-                new_input_embeds.append(cur_input_embeds)
-                continue
-
-            if self.vision_config.use_im_start_end:
-                cur_image_features = vision_hidden_states[cur_image_idx]
-                num_patches = cur_image_features.shape[0]
-                if (cur_input_ids == self.vision_config.im_start_token).sum() != (cur_input_ids == self.vision_config.im_end_token).sum():
-                    raise ValueError(
-                        "The number of image start tokens and image end tokens should be the same.")
-                image_start_tokens = torch.where(
-                    cur_input_ids == self.vision_config.im_start_token)[0]
-                for image_start_token_pos in image_start_tokens:
-                    cur_image_features = vision_hidden_states[cur_image_idx].to(
-                        device=cur_input_embeds.device)
-                    num_patches = cur_image_features.shape[0]
-                    if cur_input_ids[image_start_token_pos + num_patches + 1] != self.vision_config.im_end_token:
-                        raise ValueError(
-                            "The image end token should follow the image start token.")
-                    if orig_embeds_params is not None:
-                        cur_new_input_embeds = torch.cat((cur_input_embeds[:image_start_token_pos].detach(), cur_input_embeds[image_start_token_pos:image_start_token_pos+1], cur_image_features,
-                                                         cur_input_embeds[image_start_token_pos + num_patches + 1:image_start_token_pos + num_patches + 2], cur_input_embeds[image_start_token_pos + num_patches + 2:].detach()), dim=0)
-                    else:
-                        cur_new_input_embeds = torch.cat(
-                            (cur_input_embeds[:image_start_token_pos+1], cur_image_features, cur_input_embeds[image_start_token_pos + num_patches + 1:]), dim=0)
-                    cur_image_idx += 1
-                new_input_embeds.append(cur_new_input_embeds)
-            else:
-                raise NotImplementedError
-        inputs_embeds = torch.stack(new_input_embeds, dim=0)
+        with tracing.span("splice"):
+            inputs_embeds = self.splice_image_features(data['input_ids'], inputs_embeds, vision_hidden_states)
 
         return inputs_embeds, vision_hidden_states
 
@@ -195,9 +222,6 @@ class OmniLMMModel(MistralModel):
         **kwargs
     ) -> Union[Tuple, BaseModelOutputWithPast]:
 
-        # HACK: replace back original embeddings for LLaVA pretraining
-        orig_embeds_params = getattr(self, 'orig_embeds_params', None)
-
         if inputs_embeds is None and past_key_values is None:
           inputs_embeds = self.embed_tokens(input_ids)
 
@@ -205,57 +229,12 @@ class OmniLMMModel(MistralModel):
           if vision_tower is not None and (input_ids.shape[1] != 1 or self.training) and images is not None:
 
             if type(images) is list:
-                image_features = []
-                for image in images:
-                    image_forward_out = self.get_vision_embedding(image.unsqueeze(0))[
-                        0]
-                    image_features.append(image_forward_out)
+                image_features = self.get_vision_embeddings(images)
             else:
                 image_features = self.get_vision_embedding(images)
 
-            dummy_image_features = torch.zeros(
-                self.config.num_query,
-                self.config.hidden_size,
-                device=inputs_embeds.device,
-                dtype=inputs_embeds.dtype)
-
-            new_input_embeds = []
-            cur_image_idx = 0
-            for cur_input_ids, cur_input_embeds in zip(input_ids, inputs_embeds):
-                if (cur_input_ids == self.vision_config.im_patch_token).sum() == 0:
-                    # multimodal LLM, but the current sample is not multimodal
-                    cur_input_embeds = cur_input_embeds + \
-                        (0. * dummy_image_features).sum()
-                    new_input_embeds.append(cur_input_embeds)
-                    continue
-
-                if self.vision_config.use_im_start_end:
-                    cur_image_features = image_features[cur_image_idx]
-                    num_patches = cur_image_features.shape[0]
-                    if (cur_input_ids == self.vision_config.im_start_token).sum() != (cur_input_ids == self.vision_config.im_end_token).sum():
-                        raise ValueError(
-                            "The number of image start tokens and image end tokens should be the same.")
-                    image_start_tokens = torch.where(
-                        cur_input_ids == self.vision_config.im_start_token)[0]
-                    for image_start_token_pos in image_start_tokens:
-                        cur_image_features = image_features[cur_image_idx].to(
-                            device=cur_input_embeds.device)
-                        num_patches = cur_image_features.shape[0]
-                        if cur_input_ids[image_start_token_pos + num_patches + 1] != self.vision_config.im_end_token:
-                            raise ValueError(
-                                "The image end token should follow the image start token.")
-                        if orig_embeds_params is not None:
-                            cur_new_input_embeds = torch.cat((cur_input_embeds[:image_start_token_pos].detach(), cur_input_embeds[image_start_token_pos:image_start_token_pos+1], cur_image_features,
-                                                             cur_input_embeds[image_start_token_pos + num_patches + 1:image_start_token_pos + num_patches + 2], cur_input_embeds[image_start_token_pos + num_patches + 2:].detach()), dim=0)
-                        else:
-                            cur_new_input_embeds = torch.cat(
-                                (cur_input_embeds[:image_start_token_pos+1], cur_image_features, cur_input_embeds[image_start_token_pos + num_patches + 1:]), dim=0)
-                        cur_image_idx += 1
-                    new_input_embeds.append(cur_new_input_embeds)
-                else:
-                    raise NotImplementedError
-            inputs_embeds = torch.stack(new_input_embeds, dim=0)
-            input_ids = None
+            inputs_embeds = self.splice_image_features(input_ids, inputs_embeds, image_features)
+          input_ids = None
 
         return super(OmniLMMModel, self).forward(
             input_ids=input_ids, attention_mask=attention_mask, past_key_values=past_key_values,
@@ -137,6 +137,9 @@ class Resampler(nn.Module):
 
         self.apply(self._init_weights)
 
+        # Inference-only cache of positional terms, see _cached()
+        self._pos_cache = {}
+
     def _init_weights(self, m):
         if isinstance(m, nn.Linear):
             trunc_normal_(m.weight, std=.02)
@@ -146,19 +149,48 @@ class Resampler(nn.Module):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
+    def _cached(self, key, params, compute):
+        """
+        Return compute() memoized under `key` while gradients are off.
+
+        Entries remember the version counter and storage of every parameter
+        they were derived from, so loading or casting weights invalidates them.
+        """
+        if torch.is_grad_enabled():
+            return compute()
+        versions = tuple((p._version, p.data_ptr()) for p in params)
+        entry = self._pos_cache.get(key)
+        if entry is not None and entry[0] == versions:
+            return entry[1]
+        value = compute()
+        self._pos_cache[key] = (versions, value)
+        return value
+
+    def _key_pos_embed(self, tgt_size):
+        # Interpolates (bicubic, in float32) whenever the patch grid differs from
+        # the query grid, so it is worth caching per input grid size.
+        return self._cached(
+            ('key', tgt_size, self.pos_embed.dtype, self.pos_embed.device),
+            (self.pos_embed,),
+            lambda: get_abs_pos(self.pos_embed, tgt_size).unsqueeze(1))
+
+    def _query_with_pos(self):
+        return self._cached(
+            ('query', self.query.dtype, self.query.device),
+            (self.query, self.ln_q.weight, self.ln_q.bias, self.pos_embed),
+            lambda: self.ln_q(self.query) + self.pos_embed)
+
     def forward(self, x, attn_mask=None):
 
-        pos_embed = get_abs_pos(self.pos_embed, x.size(1))
+        pos_embed = self._key_pos_embed(x.size(1))
 
         x = self.kv_proj(x)
         x = self.ln_kv(x).permute(1, 0, 2)
 
         N = x.shape[1]
-        q = self.ln_q(self.query)
-        # print((self._repeat(q, N) + self.pos_embed.unsqueeze(1)).dtype, (x + pos_embed.unsqueeze(1)).dtype, x.dtype)
         out = self.attn(
-            self._repeat(q, N) + self.pos_embed.unsqueeze(1),
-            x + pos_embed.unsqueeze(1),
+            self._query_with_pos().unsqueeze(1).expand(-1, N, -1),
+            x + pos_embed,
             x,
             attn_mask=attn_mask)[0]
         x = out.permute(1, 0, 2)
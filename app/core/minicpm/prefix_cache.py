@@ -0,0 +1,169 @@
+import logging
+import threading
+from collections import OrderedDict
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def _slice_kv(past_key_values, start, end):
+    return tuple(
+        (key[:, :, start:end].clone(), value[:, :, start:end].clone())
+        for key, value in past_key_values
+    )
+
+
+def _kv_nbytes(past_key_values):
+    return sum(
+        key.numel() * key.element_size() + value.numel() * value.element_size()
+        for key, value in past_key_values
+    )
+
+
+class _Node:
+    __slots__ = ("keys", "kv", "children", "parent", "nbytes")
+
+    def __init__(self, keys, kv, parent):
+        self.keys = keys
+        self.kv = kv
+        self.children = {}
+        self.parent = parent
+        self.nbytes = _kv_nbytes(kv) if kv is not None else 0
+
+
+class RadixPrefixCache:
+    """
+    Radix tree over prompt token keys whose edges hold the KV cache segment
+    for those tokens (legacy `past_key_values` layout, batch size 1).
+
+    `match` returns the KV for the longest cached prefix of a prompt so only
+    the remainder has to be prefilled; `insert` adds a prompt's KV, storing
+    only the part not already in the tree. Leaves are evicted least recently
+    used first once the stored segments exceed `max_bytes`.
+
+    Recency is kept in `_lru`, which holds every node but the root. A lookup
+    moves the nodes on its path to the end, deepest first, so a node always
+    comes after its descendants and the first entry is the least recently
+    used leaf.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.matched_tokens = 0
+        self.evictions = 0
+        self._root = _Node((), None, None)
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    def match(self, keys):
+        """Return `(length, past_key_values)` for the longest cached prefix of `keys`."""
+        with self._lock:
+            node = self._root
+            segments = []
+            path = []
+            matched = 0
+            while matched < len(keys):
+                child = node.children.get(keys[matched])
+                if child is None:
+                    break
+                n = _common_length(child.keys, keys, matched)
+                path.append(child)
+                if n < len(child.keys):
+                    segments.append(tuple((k[:, :, :n], v[:, :, :n]) for k, v in child.kv))
+                    matched += n
+                    break
+                segments.append(child.kv)
+                matched += n
+                node = child
+            self._touch(path)
+
+            if matched == 0:
+                self.misses += 1
+                return 0, None
+            self.hits += 1
+            self.matched_tokens += matched
+            past_key_values = tuple(
+                (torch.cat([seg[layer][0] for seg in segments], dim=2),
+                 torch.cat([seg[layer][1] for seg in segments], dim=2))
+                for layer in range(len(segments[0]))
+            )
+            return matched, past_key_values
+
+    def insert(self, keys, past_key_values):
+        """Store the KV for `keys`; `past_key_values` must cover exactly `len(keys)` tokens."""
+        with self._lock:
+            node = self._root
+            path = []
+            pos = 0
+            while pos < len(keys):
+                child = node.children.get(keys[pos])
+                if child is None:
+                    leaf = _Node(tuple(keys[pos:]), _slice_kv(past_key_values, pos, len(keys)), node)
+                    node.children[keys[pos]] = leaf
+                    self.current_bytes += leaf.nbytes
+                    path.append(leaf)
+                    break
+                n = _common_length(child.keys, keys, pos)
+                if n < len(child.keys):
+                    child = self._split(child, n)
+                path.append(child)
+                pos += n
+                node = child
+            self._touch(path)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._root = _Node((), None, None)
+            self._lru.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "matched_tokens": self.matched_tokens,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _split(self, node, n):
+        # Both halves get their own storage so each can be evicted independently
+        # The head is on the inserting path, so it is touched (after `node`) before the insert returns
+        head = _Node(node.keys[:n], _slice_kv(node.kv, 0, n), node.parent)
+        node.parent.children[node.keys[0]] = head
+        node.keys = node.keys[n:]
+        node.kv = _slice_kv(node.kv, n, n + len(node.keys))
+        node.parent = head
+        head.children[node.keys[0]] = node
+        self.current_bytes -= node.nbytes
+        node.nbytes = _kv_nbytes(node.kv)
+        self.current_bytes += head.nbytes + node.nbytes
+        return head
+
+    def _touch(self, path):
+        for node in reversed(path):
+            self._lru[node] = None
+            self._lru.move_to_end(node)
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._lru:
+            victim, _ = self._lru.popitem(last=False)
+            del victim.parent.children[victim.keys[0]]
+            self.current_bytes -= victim.nbytes
+            self.evictions += 1
+
+
+def _common_length(edge, keys, start):
+    n = 0
+    limit = min(len(edge), len(keys) - start)
+    while n < limit and edge[n] == keys[start + n]:
+        n += 1
+    return n
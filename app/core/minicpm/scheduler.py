@@ -0,0 +1,413 @@
+import hashlib
+import logging
+import queue
+import threading
+from itertools import count
+
+import torch
+from transformers.generation.utils import GenerateDecoderOnlyOutput
+
+from .stopping import CancelledCriteria, StopSequenceCriteria
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingParams:
+    def __init__(self, max_new_tokens=1024, do_sample=True, temperature=1.0, top_p=1.0, top_k=0,
+                 repetition_penalty=1.0, eos_token_ids=()):
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample and temperature is not None and temperature > 0
+        self.temperature = temperature if self.do_sample else 1.0
+        self.top_p = top_p if top_p is not None else 1.0
+        self.top_k = top_k or 0
+        self.repetition_penalty = repetition_penalty or 1.0
+        self.eos_token_ids = set(eos_token_ids)
+
+    @classmethod
+    def from_generate_kwargs(cls, eos_token_id=None, **kwargs):
+        """Build params from the keyword arguments callers normally pass to `PreTrainedModel.generate`."""
+        if eos_token_id is None:
+            eos_token_ids = ()
+        elif isinstance(eos_token_id, int):
+            eos_token_ids = (eos_token_id,)
+        else:
+            eos_token_ids = tuple(eos_token_id)
+        return cls(
+            max_new_tokens=kwargs.get("max_new_tokens") or 1024,
+            do_sample=kwargs.get("do_sample", False),
+            temperature=kwargs.get("temperature", 1.0),
+            top_p=kwargs.get("top_p", 1.0),
+            top_k=kwargs.get("top_k", 0),
+            repetition_penalty=kwargs.get("repetition_penalty", 1.0),
+            eos_token_ids=eos_token_ids,
+        )
+
+
+class Sequence:
+    """
+    One request inside the running batch. Generated token ids are delivered
+    through `tokens`. Setting `aborted` (from any thread) retires it before
+    the next decode step, or drops it unprefilled if it is still waiting.
+    """
+
+    def __init__(self, seq_id, inputs_embeds, params, stop_matcher=None, aborted=None):
+        self.seq_id = seq_id
+        self.inputs_embeds = inputs_embeds
+        self.params = params
+        self.stop_matcher = stop_matcher
+        self.aborted = aborted or threading.Event()
+        self.output_ids = []
+        self.length = 0
+        self.finish_reason = None
+        self.prompt_keys = None
+        self.tokens = queue.Queue()
+
+    @property
+    def finished(self):
+        return self.finish_reason is not None
+
+    def __iter__(self):
+        while True:
+            token = self.tokens.get()
+            if token is None:
+                return
+            if isinstance(token, Exception):
+                raise token
+            yield token
+
+
+def _to_legacy_cache(past_key_values):
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def _left_pad(past_key_values, attention_mask, target_len):
+    pad = target_len - attention_mask.shape[1]
+    if pad == 0:
+        return past_key_values, attention_mask
+    padded = []
+    for key, value in past_key_values:
+        key = torch.nn.functional.pad(key, (0, 0, pad, 0))
+        value = torch.nn.functional.pad(value, (0, 0, pad, 0))
+        padded.append((key, value))
+    attention_mask = torch.nn.functional.pad(attention_mask, (pad, 0))
+    return tuple(padded), attention_mask
+
+
+def sample_next_tokens(logits, sequences):
+    """
+    Pick the next token for every row of `logits` using that row's own sampling params.
+
+    Mirrors the logits processors `generate` would apply (repetition penalty,
+    temperature, top-k, top-p) but vectorized across requests with different settings.
+    """
+    logits = logits.float()
+    device = logits.device
+
+    for row, seq in enumerate(sequences):
+        penalty = seq.params.repetition_penalty
+        if penalty != 1.0 and seq.output_ids:
+            ids = torch.tensor(seq.output_ids, device=device).unique()
+            score = logits[row, ids]
+            logits[row, ids] = torch.where(score < 0, score * penalty, score / penalty)
+
+    greedy = torch.tensor([not seq.params.do_sample for seq in sequences], device=device)
+    greedy_tokens = logits.argmax(dim=-1)
+    if bool(greedy.all()):
+        return greedy_tokens.tolist()
+
+    temperature = torch.tensor([seq.params.temperature for seq in sequences], device=device)
+    logits = logits / temperature.unsqueeze(1)
+
+    sorted_logits, sorted_idx = logits.sort(dim=-1, descending=True)
+    vocab_size = logits.shape[-1]
+    ranks = torch.arange(vocab_size, device=device).unsqueeze(0)
+
+    top_k = torch.tensor([seq.params.top_k if seq.params.top_k > 0 else vocab_size for seq in sequences],
+                         device=device)
+    remove = ranks >= top_k.unsqueeze(1)
+
+    top_p = torch.tensor([seq.params.top_p for seq in sequences], device=device)
+    probs = sorted_logits.masked_fill(remove, float("-inf")).softmax(dim=-1)
+    cumulative = probs.cumsum(dim=-1)
+    # Always keep the most likely token, drop everything past the nucleus
+    remove |= (cumulative - probs) > top_p.unsqueeze(1)
+
+    sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+    sampled = torch.multinomial(sorted_logits.softmax(dim=-1), num_samples=1).squeeze(1)
+    sampled_tokens = sorted_idx.gather(1, sampled.unsqueeze(1)).squeeze(1)
+
+    return torch.where(greedy, greedy_tokens, sampled_tokens).tolist()
+
+
+class ContinuousBatchingScheduler:
+    """
+    Iteration-level batching in front of a Hugging Face causal LM.
+
+    Requests arrive as prompt embeddings (the multimodal splice has already been
+    done by the backend). Before every decode step, waiting sequences are
+    prefilled and merged into the running batch; after every step, sequences
+    that hit EOS or their token budget are retired and their KV rows dropped.
+    Aborted sequences are retired the same way before the next step.
+    The batch KV cache is left-padded to a common length and masked.
+
+    With a `prefix_cache`, prompts only prefill the part after their longest
+    cached prefix, and finished sequences (prompt plus answer) are written back
+    so the next turn of the same conversation starts from them. Cache keys are
+    blake2b digests of the input embedding rows: a text row maps one-to-one to
+    its token id, and an image row depends on the image content, which plain
+    `<im_patch>` ids would not.
+
+    The answer is keyed by the LM's input embeddings of its tokens, so the
+    write-back only helps when prompts embed text the same way. Backends that
+    scale their prompt embeddings pass `cache_answers=False`.
+    """
+
+    def __init__(self, llm, max_batch_size=8, prefix_cache=None, policy=None, cache_answers=True):
+        self.llm = llm
+        self.policy = policy
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.cache_answers = cache_answers
+        self._pending = queue.Queue()
+        self._ids = count()
+        self._running = []
+        self._past_key_values = None
+        self._attention_mask = None
+        self._thread = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    @property
+    def num_running(self):
+        return len(self._running)
+
+    @property
+    def num_waiting(self):
+        return self._pending.qsize()
+
+    def submit(self, inputs_embeds, params, stop_matcher=None, aborted=None):
+        """Queue one prompt (`[seq_len, hidden]` embeddings) and return its Sequence."""
+        seq = Sequence(next(self._ids), inputs_embeds, params, stop_matcher=stop_matcher, aborted=aborted)
+        self._pending.put(seq)
+        return seq
+
+    def abort(self, seq):
+        """
+        Stop a waiting or running sequence and free its batch slot. Tokens
+        already generated stay in `output_ids` and its stream ends as usual,
+        with `finish_reason` "abort".
+        """
+        seq.aborted.set()
+
+    def generate(self, inputs_embeds=None, streamer=None, return_dict_in_generate=False,
+                 stopping_criteria=None, **kwargs):
+        """
+        Drop-in replacement for `llm.generate(inputs_embeds=...)` that routes every
+        row through the shared batch. Returns only the new tokens, as `generate`
+        does when it is given embeddings instead of input ids.
+
+        Of `stopping_criteria`, only `StopSequenceCriteria` and
+        `CancelledCriteria` are honoured: the per-row stop matchers are
+        checked by the scheduler after every token, and setting the cancel
+        event aborts the rows. If the batch fails, the error is passed to
+        `streamer.end(error)` before it is raised.
+        """
+        params = SamplingParams.from_generate_kwargs(**kwargs)
+        stop_criteria = [c for c in stopping_criteria or [] if isinstance(c, StopSequenceCriteria)]
+        cancelled = [c.cancelled for c in stopping_criteria or [] if isinstance(c, CancelledCriteria)]
+        sequences = [
+            self.submit(embeds, params,
+                        stop_matcher=stop_criteria[0].matchers[row] if stop_criteria else None,
+                        aborted=cancelled[0] if cancelled else None)
+            for row, embeds in enumerate(inputs_embeds)
+        ]
+
+        # A Sequence can only be iterated once; the streamed one is already drained
+        remaining = sequences
+        if streamer is not None:
+            error = None
+            try:
+                for token in sequences[0]:
+                    streamer.put(torch.tensor([token]))
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                # Ended even when the batch failed, or its consumer would wait forever
+                if error is None:
+                    streamer.end()
+                else:
+                    streamer.end(error)
+            remaining = sequences[1:]
+        for seq in remaining:
+            for _ in seq:
+                pass
+
+        pad_token_id = kwargs.get("pad_token_id") or 0
+        max_len = max(len(seq.output_ids) for seq in sequences)
+        output = torch.full((len(sequences), max_len), pad_token_id, dtype=torch.long)
+        for row, seq in enumerate(sequences):
+            output[row, :len(seq.output_ids)] = torch.tensor(seq.output_ids, dtype=torch.long)
+        output = output.to(inputs_embeds.device)
+
+        if return_dict_in_generate:
+            return GenerateDecoderOnlyOutput(sequences=output)
+        return output
+
+    def attach(self):
+        """Route `self.llm.generate` through this scheduler."""
+        self.llm.generate = self.generate
+
+    def _loop(self):
+        with self.policy.inference() if self.policy is not None else torch.inference_mode():
+            while True:
+                if not self._running:
+                    # Idle: block until something arrives
+                    self._admit(self._pending.get())
+                while len(self._running) < self.max_batch_size:
+                    try:
+                        self._admit(self._pending.get_nowait())
+                    except queue.Empty:
+                        break
+                if self._running:
+                    try:
+                        self._step()
+                    except Exception as e:
+                        logger.exception("batched decode step failed")
+                        for seq in self._running:
+                            seq.tokens.put(e)
+                        self._running = []
+                        self._past_key_values = None
+                        self._attention_mask = None
+
+    def _row_keys(self, embeds):
+        """Digests of the bytes of each `[seq_len, hidden]` embedding row."""
+        rows = embeds.detach().contiguous().view(torch.uint8).cpu().numpy()
+        return [hashlib.blake2b(row.tobytes(), digest_size=16).digest() for row in rows]
+
+    def _emit(self, seq, token):
+        seq.output_ids.append(token)
+        seq.tokens.put(token)
+        if token in seq.params.eos_token_ids:
+            seq.finish_reason = "stop"
+        elif seq.stop_matcher is not None and seq.stop_matcher.append(token):
+            seq.finish_reason = "stop"
+        elif len(seq.output_ids) >= seq.params.max_new_tokens:
+            seq.finish_reason = "length"
+
+    def _admit(self, seq):
+        if seq.aborted.is_set():
+            seq.finish_reason = "abort"
+            seq.tokens.put(None)
+            return
+        try:
+            cached_len, past_key_values = 0, None
+            if self.prefix_cache is not None:
+                seq.prompt_keys = self._row_keys(seq.inputs_embeds)
+                # Leave at least one token to prefill so there are logits to sample from
+                cached_len, past_key_values = self.prefix_cache.match(seq.prompt_keys[:-1])
+            inputs_embeds = seq.inputs_embeds[cached_len:].unsqueeze(0)
+            outputs = self.llm(inputs_embeds=inputs_embeds, past_key_values=past_key_values,
+                               use_cache=True, return_dict=True)
+        except Exception as e:
+            logger.exception("prefill failed")
+            seq.tokens.put(e)
+            return
+        seq.length = seq.inputs_embeds.shape[0]
+        seq.inputs_embeds = None
+        past_key_values = _to_legacy_cache(outputs.past_key_values)
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(seq.prompt_keys, past_key_values)
+
+        self._emit(seq, sample_next_tokens(outputs.logits[:, -1, :], [seq])[0])
+        if seq.finished:
+            seq.tokens.put(None)
+            return
+
+        attention_mask = torch.ones(1, seq.length, dtype=torch.long, device=inputs_embeds.device)
+        if not self._running:
+            self._past_key_values, self._attention_mask = past_key_values, attention_mask
+        else:
+            target_len = max(self._attention_mask.shape[1], seq.length)
+            batch_past, batch_mask = _left_pad(self._past_key_values, self._attention_mask, target_len)
+            past_key_values, attention_mask = _left_pad(past_key_values, attention_mask, target_len)
+            self._past_key_values = tuple(
+                (torch.cat([bk, k]), torch.cat([bv, v]))
+                for (bk, bv), (k, v) in zip(batch_past, past_key_values)
+            )
+            self._attention_mask = torch.cat([batch_mask, attention_mask])
+        self._running.append(seq)
+
+    def _step(self):
+        for seq in self._running:
+            if seq.aborted.is_set():
+                seq.finish_reason = "abort"
+        self._retire()
+        if not self._running:
+            return
+
+        device = self._attention_mask.device
+        input_ids = torch.tensor([[seq.output_ids[-1]] for seq in self._running], device=device)
+        position_ids = torch.tensor([[seq.length] for seq in self._running], device=device)
+        attention_mask = torch.cat(
+            [self._attention_mask, self._attention_mask.new_ones(len(self._running), 1)], dim=1)
+
+        outputs = self.llm(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self._past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        self._past_key_values = _to_legacy_cache(outputs.past_key_values)
+        self._attention_mask = attention_mask
+
+        tokens = sample_next_tokens(outputs.logits[:, -1, :], self._running)
+        for seq, token in zip(self._running, tokens):
+            seq.length += 1
+            self._emit(seq, token)
+        self._retire()
+
+    def _cache_finished(self, row, seq):
+        # The KV holds the prompt plus every generated token except the last,
+        # which was sampled but never fed back through the model.
+        valid = self._attention_mask[row].bool()
+        past_key_values = tuple(
+            (key[row:row + 1, :, valid], value[row:row + 1, :, valid])
+            for key, value in self._past_key_values
+        )
+        generated = seq.output_ids[:seq.length - len(seq.prompt_keys)]
+        if generated:
+            embeds = self.llm.get_input_embeddings()(
+                torch.tensor(generated, device=self._attention_mask.device))
+            keys = seq.prompt_keys + self._row_keys(embeds)
+        else:
+            keys = seq.prompt_keys
+        self.prefix_cache.insert(keys, past_key_values)
+
+    def _retire(self):
+        keep = [row for row, seq in enumerate(self._running) if not seq.finished]
+        if len(keep) == len(self._running):
+            return
+        for row, seq in enumerate(self._running):
+            if seq.finished:
+                if self.prefix_cache is not None and self.cache_answers:
+                    self._cache_finished(row, seq)
+                seq.tokens.put(None)
+        self._running = [self._running[row] for row in keep]
+        if not keep:
+            self._past_key_values = None
+            self._attention_mask = None
+            return
+
+        index = torch.tensor(keep, device=self._attention_mask.device)
+        attention_mask = self._attention_mask.index_select(0, index)
+        # Columns that are padding for every remaining row can be dropped
+        start = int(attention_mask.any(dim=0).long().argmax())
+        self._attention_mask = attention_mask[:, start:]
+        self._past_key_values = tuple(
+            (key.index_select(0, index)[:, :, start:], value.index_select(0, index)[:, :, start:])
+            for key, value in self._past_key_values
+        )
@@ -0,0 +1,115 @@
+import torch
+from transformers import StoppingCriteria
+
+from .detokenizer import IncrementalDetokenizer
+
+
+def normalize_stop(stop):
+    """Accept the OpenAI `stop` field (None, a string or a list of strings) and drop empty entries."""
+    if stop is None:
+        return []
+    if isinstance(stop, str):
+        stop = [stop]
+    return [s for s in stop if s]
+
+
+def truncate_at_stop(text, stop):
+    """Cut `text` at the earliest occurrence of any stop string."""
+    cut = len(text)
+    for s in stop:
+        idx = text.find(s, 0, cut + len(s))
+        if idx != -1:
+            cut = min(cut, idx)
+    return text[:cut]
+
+
+class StopStringFilter:
+    """
+    Applies stop strings to a stream of text chunks.
+
+    Only the last `len(longest stop) - 1` characters are ever re-examined, and
+    that tail is held back from the output until it can no longer turn into a
+    stop string, so nothing past a stop string is ever emitted.
+    """
+
+    def __init__(self, stop):
+        self.stop = normalize_stop(stop)
+        self.window = max((len(s) for s in self.stop), default=1)
+        self.pending = ""
+        self.stopped = False
+
+    def feed(self, text):
+        """Return `(text_to_emit, stopped)` for the next chunk."""
+        if self.stopped:
+            return "", True
+        buffer = self.pending + text
+        cut = -1
+        for s in self.stop:
+            idx = buffer.find(s)
+            if idx != -1 and (cut == -1 or idx < cut):
+                cut = idx
+        if cut != -1:
+            self.stopped = True
+            self.pending = ""
+            return buffer[:cut], True
+        keep = self.window - 1
+        if keep and len(buffer) > keep:
+            self.pending = buffer[-keep:]
+            return buffer[:-keep], False
+        if keep:
+            self.pending = buffer
+            return "", False
+        return buffer, False
+
+    def flush(self):
+        text, self.pending = self.pending, ""
+        return text
+
+
+class StopSequenceMatcher:
+    """Token-by-token stop string detection for a single generated sequence."""
+
+    def __init__(self, stop, tokenizer):
+        self._decoder = IncrementalDetokenizer(tokenizer)
+        self._filter = StopStringFilter(stop)
+
+    @property
+    def stopped(self):
+        return self._filter.stopped
+
+    def append(self, token_id):
+        """Feed the newest token; returns True once a stop string has been generated."""
+        if not self._filter.stopped:
+            self._filter.feed(self._decoder.append(token_id))
+        return self._filter.stopped
+
+
+class StopSequenceCriteria(StoppingCriteria):
+    """
+    `generate` stopping criterion for `request.stop`.
+
+    Unlike `KeywordsStoppingCriteria`, which re-decodes the whole generated
+    suffix at every step, each row keeps its own incremental matcher and only
+    looks at the newest token, so the cost per step does not grow with the
+    output length. Rows stop independently.
+    """
+
+    def __init__(self, stop, tokenizer, batch_size=1):
+        self.matchers = [StopSequenceMatcher(stop, tokenizer) for _ in range(batch_size)]
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        done = [
+            matcher.append(token_id)
+            for matcher, token_id in zip(self.matchers, input_ids[:, -1].tolist())
+        ]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class CancelledCriteria(StoppingCriteria):
+    """`generate` stopping criterion that ends every row once `cancelled` (a `threading.Event`) is set."""
+
+    def __init__(self, cancelled):
+        self.cancelled = cancelled
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.cancelled.is_set(), dtype=torch.bool, device=input_ids.device)
@@ -0,0 +1,188 @@
+import contextvars
+import logging
+import threading
+import time
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors
+from transformers import PreTrainedTokenizerFast
+
+from app.api.v1.models.chat_completions import ChatCompletionsRequest
+from app.core.image_decode import ImageDecoder
+from app.core.image_fetch import ImageFetchError
+from app.core.usage import Usage
+
+from .detokenizer import TokenCounter, TokenStreamer
+from .minicpm_v import (
+    OmniLMM12B, apply_stop_to_stream, instrument, setup_omni_lmm, truncate_at_stop,
+)
+from .omnilmm.model.omnilmm import OmniLMMConfig, OmniLMMForCausalLM
+from .stopping import normalize_stop
+
+logger = logging.getLogger(__name__)
+
+# OmniLMM's prompt format: the turns `omni_preprocess` looks for are "\n<|user|>\n" and "\n<|assistant|>\n"
+OMNI_LMM_CHAT_TEMPLATE = (
+    "{{ bos_token }}{% for message in messages %}"
+    "{{ '\n<|' + message['role'] + '|>\n' + message['content'] }}"
+    "{% if message['role'] != 'system' %}{{ eos_token }}{% endif %}"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}{{ '\n<|assistant|>\n' }}{% endif %}"
+)
+
+
+def build_byte_tokenizer(model_max_length=2048):
+    """
+    A byte-level tokenizer that needs no files: every UTF-8 byte is one token,
+    after `<unk>`, `<s>` and `</s>`. It goes through the same HF fast-tokenizer,
+    chat template and byte-level decoding code as the real ones.
+    """
+    special = ["<unk>", "<s>", "</s>"]
+    vocab = {token: i for i, token in enumerate(special + sorted(pre_tokenizers.ByteLevel.alphabet()))}
+    tokenizer = Tokenizer(models.BPE(vocab=vocab, merges=[], unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False, use_regex=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="<s> $A", pair="<s> $A <s> $B", special_tokens=[("<s>", 1)])
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        unk_token="<unk>", bos_token="<s>", eos_token="</s>", pad_token="<unk>",
+        model_max_length=model_max_length,
+        chat_template=OMNI_LMM_CHAT_TEMPLATE,
+    )
+
+
+class TinyOmniLMM(OmniLMM12B):
+    """
+    OmniLMM with a randomly initialized miniature Mistral decoder, EVA02
+    vision tower and resampler, built in memory with the byte tokenizer.
+
+    Every serving step runs the real code (prompt building and
+    tokenization, image transform, vision encode, splice, generate,
+    detokenization), only on a model small enough for a CPU, so it is meant
+    for profiling and regression-testing the serving path. Answers are
+    random text, and usually run to `max_tokens`.
+    """
+
+    # Its exported checkpoints are regular OmniLMM ones
+    artifact_backend = "omnilmm-12b"
+
+    def __init__(self, model_path="tiny-omnilmm", max_batch_size=0, vision_cache_bytes=0, prefix_cache_bytes=0,
+                 image_decoder=None, policy=None, quantization=None, vision_batch_size=8, seed=0):
+        self.seed = seed
+        super().__init__(model_path, max_batch_size=max_batch_size, vision_cache_bytes=vision_cache_bytes,
+                         prefix_cache_bytes=prefix_cache_bytes, image_decoder=image_decoder,
+                         policy=policy, quantization=quantization, vision_batch_size=vision_batch_size)
+
+    def load(self, model_path):
+        tokenizer = build_byte_tokenizer()
+        # The three image tokens are added by setup_omni_lmm
+        config = OmniLMMConfig(
+            vocab_size=len(tokenizer) + 3,
+            hidden_size=128,
+            intermediate_size=256,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            num_key_value_heads=2,
+            max_position_embeddings=4096,
+            bos_token_id=tokenizer.bos_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+            mm_vision_tower="tiny",
+            mm_use_im_start_end=True,
+            num_query=16,
+            image_size=56,
+            vision_tower_name="eva02_tiny_patch14_224",
+            vision_tower_kwargs={"depth": 2, "img_size": 56},
+        )
+        torch.manual_seed(self.seed)
+        model = OmniLMMForCausalLM(config).to(device=self.policy.device, dtype=self.policy.dtype)
+        logger.info(f"Tiny OmniLMM built ({sum(p.numel() for p in model.parameters())} parameters) "
+                    f"on {self.policy.device}")
+        return (model,) + setup_omni_lmm(model, tokenizer)
+
+
+FAKE_ANSWER = ("This is a stub answer from the fake backend, produced at a fixed pace "
+               "so the serving path can be measured without a model. ")
+
+
+class FakeChat:
+    """
+    Deterministic stand-in for a model with configurable latency: after
+    `prefill_latency` seconds it emits the tokens of a fixed answer, one every
+    `token_latency` seconds, up to `max_tokens`.
+
+    Images are decoded and the prompt is tokenized with the byte tokenizer,
+    and tokens go through the real detokenizer, stop handling and usage
+    accounting, so everything around the model costs what it does in
+    production.
+    """
+
+    def __init__(self, model_path="stub", token_latency=0.02, prefill_latency=0.0, answer_tokens=256,
+                 image_decoder=None, image_area=448 * 448):
+        self.token_latency = token_latency
+        self.prefill_latency = prefill_latency
+        self.answer_tokens = answer_tokens
+        self.image_area = image_area
+        self.tokenizer = build_byte_tokenizer(model_max_length=1 << 20)
+        self.image_decoder = image_decoder or ImageDecoder()
+        instrument(self)
+        answer_ids = self.tokenizer(FAKE_ANSWER, add_special_tokens=False).input_ids
+        self._answer_ids = (answer_ids * (answer_tokens // len(answer_ids) + 1))[:answer_tokens]
+
+    def _prompt(self, input):
+        msgs = []
+        payloads = []
+        for message in input.messages:
+            if isinstance(message.content, str):
+                msgs.append({"role": message.role, "content": message.content})
+                continue
+            texts = []
+            for item in message.content:
+                if isinstance(item, dict) and item.get('type') == "text":
+                    texts.append(item['text'])
+                elif isinstance(item, dict) and item.get('type') == "image_url":
+                    url = item.get('image_url', {}).get('url', '')
+                    if url.startswith(("http://", "https://")):
+                        data = input.remote_image(url)
+                        if data is None:
+                            raise ImageFetchError(f"Image {url} was not fetched")
+                        payloads.append(data)
+                    else:
+                        payloads.append(url.split(',', 1)[-1])
+            msgs.append({"role": message.role, "content": '\n'.join(texts)})
+        return msgs, payloads
+
+    def chat(self, input: ChatCompletionsRequest, usage=None, cancelled=None):
+        usage = usage if usage is not None else Usage()
+        msgs, payloads = self._prompt(input)
+        images = self.decode_images(payloads, min_area=self.image_area) if payloads else []
+        prompt = self.tokenizer.apply_chat_template(msgs, tokenize=False, add_generation_prompt=True)
+        input_ids = self.tokenizer(prompt, add_special_tokens=False).input_ids
+        # Count each image like one 448x448 slice of MiniCPM-V 2.5 (96 query tokens)
+        usage.start_generation(len(input_ids) + 96 * len(images))
+
+        ids = self._answer_ids[:input.max_tokens] if input.max_tokens else self._answer_ids
+        stop = normalize_stop(input.stop)
+        if input.stream:
+            streamer = TokenStreamer(self.tokenizer, usage=usage)
+            # Like the real backends' generate threads, it runs in a copy of the request's context
+            threading.Thread(
+                target=contextvars.copy_context().run, args=(self._generate, streamer, ids, cancelled),
+                daemon=True,
+            ).start()
+            return apply_stop_to_stream(streamer, stop) if stop else streamer
+        self._generate(TokenCounter(usage), ids, cancelled)
+        answer = self.tokenizer.decode(ids, skip_special_tokens=True)
+        return truncate_at_stop(answer, stop) if stop else answer
+
+    def _generate(self, streamer, ids, cancelled=None):
+        # Like `generate`, the streamer first gets the prompt and then one token per step
+        streamer.put(torch.empty(0, dtype=torch.long))
+        time.sleep(self.prefill_latency)
+        for token_id in ids:
+            if cancelled is not None and cancelled.is_set():
+                break
+            time.sleep(self.token_latency)
+            streamer.put(torch.tensor([token_id]))
+        streamer.end()
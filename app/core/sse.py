@@ -0,0 +1,74 @@
+import asyncio
+import json
+from json.encoder import encode_basestring
+
+# Last event of a stream, as the OpenAI API sends it
+DONE = "data: [DONE]\n\n"
+
+
+class ChatCompletionChunkEncoder:
+    """
+    Renders `chat.completion.chunk` server-sent events for one stream.
+
+    Everything except the delta text is the same for every chunk of a stream,
+    so the envelope is serialized once up front and each event only escapes
+    the new text (`encode_basestring` is the C string escaper `json.dumps`
+    uses with `ensure_ascii=False`).
+    """
+
+    def __init__(self, completion_id, model, created, role="assistant", index=0):
+        envelope = json.dumps({
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+        }, ensure_ascii=False)
+        self._envelope = envelope[:-1]
+        head = f'data: {self._envelope}, "choices": [{{"index": {index}, "delta": {{"role": {json.dumps(role)}, "content": '
+        self._head = head
+        self._tail = '}, "finish_reason": null}]}\n\n'
+
+    def chunk(self, text):
+        return self._head + encode_basestring(text) + self._tail
+
+    def finish(self, finish_reason="stop", text=""):
+        tail = '}, "finish_reason": ' + json.dumps(finish_reason) + '}]}\n\n'
+        return self._head + encode_basestring(text) + tail
+
+    def usage(self, usage):
+        """The extra last chunk sent for `stream_options.include_usage`."""
+        return f'data: {self._envelope}, "choices": [], "usage": {json.dumps(usage)}}}\n\n'
+
+    def error(self, message, type, code):
+        """An OpenAI-style error event, for a stream that fails after the response has started."""
+        return "data: " + json.dumps({"error": {"message": message, "type": type, "code": code}},
+                                     ensure_ascii=False) + "\n\n"
+
+
+async def coalesce(channel, window_ms=0, max_bytes=0):
+    """
+    Group the text chunks of a TokenChannel into larger pieces.
+
+    Whatever is already buffered is always merged into the next piece. With
+    `window_ms`, a piece is held open for up to that long after its first chunk
+    to collect more, and emitted early once it reaches `max_bytes` of UTF-8.
+    """
+    loop = asyncio.get_running_loop()
+    window = window_ms / 1000
+    async for text in channel:
+        parts = [text]
+        parts.extend(channel.drain())
+        if window > 0:
+            size = sum(len(t.encode()) for t in parts)
+            deadline = loop.time() + window
+            while not max_bytes or size < max_bytes:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                await channel.wait(remaining)
+                more = channel.drain()
+                if not more:
+                    break
+                parts.extend(more)
+                size += sum(len(t.encode()) for t in more)
+        yield "".join(parts)
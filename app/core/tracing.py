@@ -0,0 +1,232 @@
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar("trace", default=None)
+
+
+def now_us():
+    return time.perf_counter_ns() // 1000
+
+
+class Trace:
+    """
+    Spans of one sampled request, stored as Chrome trace "complete" events
+    (microseconds on the `perf_counter` clock). Spans may be added from any
+    thread; each one is tagged with the thread it ran on.
+    """
+
+    def __init__(self, name):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.started_at = now_us()
+        self.events = []
+        self._threads = {}
+
+    def add(self, name, start_us, end_us, args=None):
+        thread = threading.current_thread()
+        self._threads.setdefault(thread.ident, thread.name)
+        event = {"name": name, "ph": "X", "ts": start_us, "dur": end_us - start_us, "pid": 1, "tid": thread.ident}
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    def stage_totals(self):
+        """Total milliseconds per span name, for the `Server-Timing` header."""
+        totals = {}
+        for event in list(self.events):
+            totals[event["name"]] = totals.get(event["name"], 0) + event["dur"] / 1000
+        return totals
+
+    def to_chrome(self):
+        meta = [
+            {"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": name}}
+            for tid, name in self._threads.items()
+        ]
+        meta.append({"name": "process_name", "ph": "M", "pid": 1, "args": {"name": f"{self.name} {self.trace_id}"}})
+        return {"traceEvents": meta + list(self.events), "displayTimeUnit": "ms"}
+
+
+class _Span:
+    __slots__ = ("trace", "name", "args", "start")
+
+    def __init__(self, trace, name, args):
+        self.trace = trace
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = now_us()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.name, self.start, now_us(), self.args)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+def current():
+    """The trace of the request being handled on this thread/task, or None when it is not sampled."""
+    return _current.get()
+
+
+def span(name, **args):
+    """`with span("stage"):` records a span on the current trace; a shared no-op when there is none."""
+    trace = _current.get()
+    if trace is None:
+        return _NOOP
+    return _Span(trace, name, args)
+
+
+def traced(fn, name):
+    """Wrap `fn` so every call is recorded as a span when a trace is current."""
+    def wrapper(*args, **kwargs):
+        trace = _current.get()
+        if trace is None:
+            return fn(*args, **kwargs)
+        with _Span(trace, name, None):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def activate(trace):
+    """Make `trace` current on this thread (e.g. an inference worker); returns a token for `deactivate`."""
+    return _current.set(trace)
+
+
+def deactivate(token):
+    _current.reset(token)
+
+
+class StepTracer:
+    """
+    Records generation steps on a trace from a `generate` streamer: the wait
+    for the first token as "prefill" and every later one as "decode.step".
+    Created on the thread that starts generation, since `generate` itself
+    often runs on a thread of its own where no trace is current.
+    """
+
+    __slots__ = ("trace", "last", "steps")
+
+    def __init__(self, trace):
+        self.trace = trace
+        self.last = now_us()
+        self.steps = 0
+
+    def step(self):
+        now = now_us()
+        self.trace.add("prefill" if self.steps == 0 else "decode.step", self.last, now)
+        self.last = now
+        self.steps += 1
+
+
+def step_tracer():
+    trace = _current.get()
+    return StepTracer(trace) if trace is not None else None
+
+
+class TraceExporter:
+    """Writes finished traces as Chrome trace / Perfetto JSON files on a background thread."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trace-writer")
+
+    def export(self, trace):
+        self._writer.submit(self._write, trace)
+
+    def _write(self, trace):
+        path = os.path.join(self.directory, f"trace-{int(time.time())}-{trace.trace_id}.json")
+        try:
+            with open(path, "w") as f:
+                json.dump(trace.to_chrome(), f)
+        except OSError:
+            logger.exception("failed to write trace %s", path)
+
+    def shutdown(self):
+        self._writer.shutdown()
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware that samples requests for tracing. Only requests whose
+    path starts with one of `path_prefixes` are sampled, so health checks
+    and metrics scrapes do not use up the sample.
+
+    A sampled request gets a Trace that is current for the endpoint and its
+    streaming body. Its first span, "http.parse", covers the time until the
+    endpoint calls `mark_handler_start`, which is mostly reading and
+    validating the JSON body. With `server_timing`, the stages finished
+    before the response starts are summarized in a `Server-Timing` header.
+    The trace is exported once the last body chunk has been sent.
+    """
+
+    def __init__(self, app, sample_rate=0.0, exporter=None, server_timing=False, path_prefixes=("/v1/",)):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+        self.server_timing = server_timing
+        self.path_prefixes = tuple(path_prefixes)
+
+    def _sampled(self, scope):
+        if scope["type"] != "http":
+            return False
+        path = scope["path"]
+        root_path = scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        return path.startswith(self.path_prefixes) and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if not self._sampled(scope):
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(f"{scope['method']} {scope['path']}")
+        token = _current.set(trace)
+
+        async def send_traced(message):
+            if message["type"] == "http.response.start" and self.server_timing:
+                header = ", ".join(
+                    f"{name.replace('.', '_')};dur={ms:.2f}" for name, ms in trace.stage_totals().items())
+                message = dict(message, headers=list(message.get("headers", [])) + [
+                    (b"server-timing", header.encode("latin-1")),
+                ])
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                trace.add("request", trace.started_at, now_us())
+                if self.exporter is not None:
+                    self.exporter.export(trace)
+
+        try:
+            await self.app(scope, receive, send_traced)
+        finally:
+            _current.reset(token)
+
+
+def mark_handler_start():
+    """Close the "http.parse" span of the current trace; call first thing in an endpoint."""
+    trace = _current.get()
+    if trace is not None:
+        trace.add("http.parse", trace.started_at, now_us())
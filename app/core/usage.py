@@ -0,0 +1,50 @@
+import time
+
+
+class Usage:
+    """
+    Token counts of one chat completion, filled in by the backend while it runs.
+
+    `prompt_tokens` is the length of the prepared prompt as the model sees it,
+    image query tokens included; `completion_tokens` counts generated ids.
+    The `time.monotonic()` timestamps of generation start and of the first
+    and latest token are kept for latency metrics, and every gap between
+    tokens is reported to `inter_token` (a histogram series) when one is set.
+    """
+
+    __slots__ = ("prompt_tokens", "completion_tokens", "generation_started_at",
+                 "first_token_at", "last_token_at", "inter_token")
+
+    def __init__(self, prompt_tokens=0, completion_tokens=0):
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.generation_started_at = None
+        self.first_token_at = None
+        self.last_token_at = None
+        self.inter_token = None
+
+    @property
+    def total_tokens(self):
+        return self.prompt_tokens + self.completion_tokens
+
+    def start_generation(self, prompt_tokens):
+        self.prompt_tokens = prompt_tokens
+        self.generation_started_at = time.monotonic()
+
+    def add_tokens(self, count):
+        if not count:
+            return
+        now = time.monotonic()
+        if self.last_token_at is None:
+            self.first_token_at = now
+        elif self.inter_token is not None:
+            self.inter_token.observe(now - self.last_token_at)
+        self.last_token_at = now
+        self.completion_tokens += count
+
+    def to_dict(self):
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+        }
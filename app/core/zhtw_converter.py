@@ -0,0 +1,131 @@
+import io
+import json
+import logging
+import os
+
+import opencc
+
+logger = logging.getLogger(__name__)
+
+OPENCC_DIR = os.path.dirname(opencc.__file__)
+
+
+def _dict_files(spec):
+    if spec.get("type") == "group":
+        files = []
+        for item in spec.get("dicts", []):
+            files.extend(_dict_files(item))
+        return files
+    if spec.get("type") == "txt":
+        return [os.path.join(OPENCC_DIR, "dictionary", spec["file"])]
+    raise ValueError(f"unsupported OpenCC dictionary type: {spec.get('type')}")
+
+
+class _Stage:
+    """
+    One step of an OpenCC conversion chain (a dictionary, or a group of
+    dictionaries where the first one listed wins on identical keys).
+
+    The phrase table is stored as a flattened trie: `mapping` holds the
+    complete phrases and `prefixes` every prefix of every phrase, so a
+    longest-match walk stops at the first character that cannot extend any
+    phrase instead of probing every length up to the longest key.
+    """
+
+    def __init__(self, paths):
+        self.mapping = {}
+        for path in paths:
+            with io.open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    key, _, value = line.rstrip("\n").partition("\t")
+                    if key and key not in self.mapping:
+                        # Several alternatives are space separated; take the first like opencc does
+                        self.mapping[key] = value.split(" ")[0]
+        self.prefixes = {key[:n] for key in self.mapping for n in range(1, len(key) + 1)}
+        self.max_length = max((len(key) for key in self.mapping), default=1)
+
+    def convert(self, text, final=True):
+        """
+        Forward maximum matching over `text`. Returns `(converted, pending)`
+        where `pending` is the unconverted tail that could still be the start
+        of a longer phrase once more text arrives (always empty when `final`).
+        """
+        mapping, prefixes = self.mapping, self.prefixes
+        out = []
+        i, n = 0, len(text)
+        while i < n:
+            if text[i] not in prefixes:
+                out.append(text[i])
+                i += 1
+                continue
+            match = 0
+            k = i + 1
+            while k <= n and text[i:k] in prefixes:
+                if text[i:k] in mapping:
+                    match = k - i
+                k += 1
+            if k > n and not final:
+                break
+            if match:
+                out.append(mapping[text[i:i + match]])
+                i += match
+            else:
+                out.append(text[i])
+                i += 1
+        return "".join(out), text[i:]
+
+
+class ZhtwConverter:
+    """
+    Drop-in replacement for `opencc.OpenCC(config).convert` that reads the
+    same config and dictionaries from the installed opencc package, but builds
+    the phrase tables once and converts in a single left-to-right pass.
+
+    Use `stream()` to convert text that arrives in chunks.
+    """
+
+    def __init__(self, config="s2twp"):
+        with open(os.path.join(OPENCC_DIR, "config", config + ".json")) as f:
+            setting = json.load(f)
+        self.config = config
+        self.stages = [_Stage(_dict_files(item["dict"])) for item in setting["conversion_chain"]]
+        logger.info("Loaded OpenCC %s: %s phrases", config, sum(len(s.mapping) for s in self.stages))
+
+    def convert(self, text):
+        for stage in self.stages:
+            text, _ = stage.convert(text)
+        return text
+
+    def stream(self):
+        return IncrementalZhtwConverter(self)
+
+
+class IncrementalZhtwConverter:
+    """
+    Converts a stream of text chunks with the same result as converting the
+    concatenated text in one go.
+
+    Each stage holds back only the tail that is still a prefix of some phrase
+    (at most the longest phrase length), so a phrase split across two chunks
+    is converted as a whole instead of character by character.
+    """
+
+    def __init__(self, converter):
+        self.stages = converter.stages
+        self.pending = [""] * len(self.stages)
+
+    def feed(self, text):
+        """Return the converted text that can no longer change."""
+        for i, stage in enumerate(self.stages):
+            text, self.pending[i] = stage.convert(self.pending[i] + text, final=False)
+            if not text:
+                return ""
+        return text
+
+    def flush(self):
+        """Convert and return everything still held back."""
+        text = ""
+        for i, stage in enumerate(self.stages):
+            text, _ = stage.convert(self.pending[i] + text)
+            self.pending[i] = ""
+        return text
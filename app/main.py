@@ -1,37 +1,151 @@
 import logging
 import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from app.api.v1.api_v1 import router as api_v1_router
+from app.api.health import router as health_router
+from app.api.metrics import router as metrics_router
 from starlette.middleware.cors import CORSMiddleware
 import torch
+from app.core.backends import ModelLoader, parse_dtype
+from app.core.device import DevicePolicy, parse_autocast
 from app.core.minicpm.minicpm_v import MiniCPMVChat
-import opencc
+from app.core.executor import InferenceExecutor
+from app.core.image_decode import ImageDecoder
+from app.core.image_fetch import ImageFetcher
+from app.core.zhtw_converter import ZhtwConverter
+from app.core.log import setup_logging
+from app.core.metrics import bind_model_gauges, process_memory
+from app.core.minicpm.fast_load import shared_checkpoint
+from app.core.tracing import TraceExporter, TracingMiddleware
 
 logger = logging.getLogger(__name__)
 
 logger = logging.getLogger()
 log_format = "[%(asctime)s] {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s"
 log_level = os.getenv("LOG_LEVEL", "info").upper()
-logging.basicConfig(level=getattr(logging, log_level), format=log_format)
-
-file_handler = logging.FileHandler("app.log")
-logger.addHandler(file_handler)
+log_listener = setup_logging(
+    level=getattr(logging, log_level),
+    log_format=log_format,
+    log_file=os.getenv("LOG_FILE", "app.log") or None,
+    json_logs=os.getenv("LOG_JSON", "false") == 'true',
+)
 
-chat_model = MiniCPMVChat("openbmb/MiniCPM-Llama3-V-2_5")
-opencc_converter = opencc.OpenCC("s2twp")
+# With continuous batching on, each in-flight request needs its own worker thread
+# to feed the shared batch, so the worker count defaults to the batch size.
+max_batch_size = int(os.getenv("MAX_BATCH_SIZE", "0"))
+# Device and dtype default to the GPU when there is one, else the CPU (bf16 where it is native)
+device_policy = DevicePolicy(
+    device=os.getenv("MODEL_DEVICE") or None,
+    dtype=parse_dtype(os.getenv("MODEL_DTYPE")),
+    autocast=parse_autocast(os.getenv("MODEL_AUTOCAST")),
+    num_threads=int(os.getenv("TORCH_THREADS_PER_WORKER", "0")),
+    num_interop_threads=int(os.getenv("TORCH_INTEROP_THREADS", "0")),
+    allow_tf32=os.getenv("MODEL_TF32", "true") == 'true',
+)
+image_decoder = ImageDecoder(
+    num_workers=int(os.getenv("IMAGE_DECODE_WORKERS", "2")),
+    max_pixels=int(os.getenv("MAX_IMAGE_PIXELS", "25000000")),
+)
+image_fetcher = ImageFetcher(
+    timeout=float(os.getenv("IMAGE_FETCH_TIMEOUT", "10")),
+    max_bytes=int(os.getenv("IMAGE_FETCH_MAX_MB", "20")) * 1024 * 1024,
+    cache_bytes=int(os.getenv("IMAGE_FETCH_CACHE_MB", "128")) * 1024 * 1024,
+    ttl=int(os.getenv("IMAGE_FETCH_TTL", "300")),
+    enabled=os.getenv("IMAGE_FETCH_ENABLED", "false") == 'true',
+    allowed_hosts=[host for host in os.getenv("IMAGE_FETCH_ALLOWED_HOSTS", "").split(",") if host],
+    allow_private=os.getenv("IMAGE_FETCH_ALLOW_PRIVATE", "false") == 'true',
+)
+opencc_converter = ZhtwConverter("s2twp")
 
 import globals
-globals.chat_model = chat_model
+globals.image_fetcher = image_fetcher
 globals.opencc_converter = opencc_converter
 
+
+def load_model(loader):
+    """Runs on the loader thread; chat requests get 503 until it has published the executor."""
+    # `stub` and `tiny-omnilmm` run without checkpoints or a GPU (see README)
+    model_path = os.getenv("MODEL_PATH", "openbmb/MiniCPM-Llama3-V-2_5")
+    backend = os.getenv("MODEL_BACKEND") or None
+    load_threads = int(os.getenv("MODEL_LOAD_THREADS", "8"))
+    quantization = os.getenv("MODEL_QUANTIZATION") or None
+    shared_dir = os.getenv("MODEL_SHARED_DIR")
+    if shared_dir:
+        # Workers load one serving artifact, whose weights they all map instead of copying (see README)
+        loader.phase("sharing")
+        model_path, backend = shared_checkpoint(
+            model_path, shared_dir, backend=backend, policy=device_policy, load_threads=load_threads)
+        if quantization:
+            logger.warning("Quantized layers are private to each worker; only the rest of the weights are shared")
+    loader.phase("loading")
+    chat_model = MiniCPMVChat(
+        model_path,
+        backend=backend,
+        policy=device_policy,
+        max_batch_size=max_batch_size,
+        vision_cache_bytes=int(os.getenv("VISION_CACHE_MB", "512")) * 1024 * 1024,
+        vision_batch_size=int(os.getenv("VISION_BATCH_SIZE", "8")),
+        prefix_cache_bytes=int(os.getenv("PREFIX_CACHE_MB", "0")) * 1024 * 1024,
+        image_decoder=image_decoder,
+        load_threads=load_threads,
+        quantization=quantization,
+        token_latency=float(os.getenv("STUB_TOKEN_LATENCY_MS", "20")) / 1000,
+    )
+    if os.getenv("MODEL_WARMUP", "true") == 'true':
+        loader.phase("warming")
+        chat_model.warm_up()
+    inference_executor = InferenceExecutor(
+        chat_model,
+        num_workers=int(os.getenv("INFERENCE_WORKERS", str(max(max_batch_size, 1)))),
+        max_queue_size=int(os.getenv("INFERENCE_QUEUE_SIZE", "0")),
+    )
+
+    scheduler = getattr(chat_model.model, "scheduler", None)
+    caches = {
+        "vision": getattr(chat_model.model, "vision_cache", None),
+        "prefix": scheduler.prefix_cache if scheduler is not None else None,
+        "image_fetch": image_fetcher,
+    }
+    bind_model_gauges(
+        inference_executor,
+        scheduler=scheduler,
+        caches={name: cache for name, cache in caches.items() if cache is not None},
+    )
+    globals.chat_model = chat_model
+    globals.inference_executor = inference_executor
+    memory = process_memory()
+    logger.info(f"Worker {os.getpid()} memory: " + ", ".join(f"{kind} {size / 2**20:.0f} MB"
+                                                              for kind, size in memory.items()))
+
+
+# The model loads in the background once the server is up, so the port is
+# bound and /health answers right away; /ready turns 200 once it is warm.
+model_loader = ModelLoader(load_model)
+globals.model_loader = model_loader
+
 root_path = os.getenv("ROOT_PATH", "")
 
+
+@asynccontextmanager
+async def lifespan(app):
+    model_loader.start()
+    yield
+    if globals.inference_executor is not None:
+        globals.inference_executor.shutdown()
+    image_decoder.shutdown()
+    await image_fetcher.aclose()
+    if trace_exporter is not None:
+        trace_exporter.shutdown()
+    log_listener.stop()
+
+
 if os.getenv("PROD_MODE", "false") == 'true':
     logger.info("Run in prod mode")
-    app = FastAPI(docs_url=None, redoc_url=None, root_path=root_path)
+    app = FastAPI(docs_url=None, redoc_url=None, root_path=root_path, lifespan=lifespan)
 else:
     logger.info("Run in dev mode")
-    app = FastAPI(root_path=root_path)
+    app = FastAPI(root_path=root_path, lifespan=lifespan)
 
 # CORS
 app.add_middleware(
@@ -42,4 +156,21 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request tracing: a sampled fraction of requests is written to TRACE_DIR as
+# Chrome trace JSON (chrome://tracing, ui.perfetto.dev). Off by default.
+trace_sample_rate = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+trace_exporter = None
+if trace_sample_rate > 0:
+    trace_exporter = TraceExporter(os.getenv("TRACE_DIR", "traces"))
+    app.add_middleware(
+        TracingMiddleware,
+        sample_rate=trace_sample_rate,
+        exporter=trace_exporter,
+        server_timing=os.getenv("TRACE_SERVER_TIMING", "false") == 'true',
+        path_prefixes=[prefix for prefix in os.getenv("TRACE_PATHS", "/v1/").split(",") if prefix],
+    )
+    logger.info(f"Request tracing enabled (sample rate {trace_sample_rate})")
+
 app.include_router(api_v1_router, prefix="/v1")
+app.include_router(metrics_router)
+app.include_router(health_router)
@@ -1,6 +1,13 @@
 from typing import Optional
+from app.core.backends import ModelLoader
 from app.core.minicpm.minicpm_v import MiniCPMVChat
-from opencc import OpenCC
+from app.core.executor import InferenceExecutor
+from app.core.image_fetch import ImageFetcher
+from app.core.zhtw_converter import ZhtwConverter
 
-chat_model: MiniCPMVChat
-opencc_converter: OpenCC
\ No newline at end of file
+model_loader: ModelLoader
+# Set by the model loader once the model is ready
+chat_model: Optional[MiniCPMVChat] = None
+inference_executor: Optional[InferenceExecutor] = None
+image_fetcher: ImageFetcher
+opencc_converter: ZhtwConverter
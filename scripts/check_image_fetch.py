@@ -0,0 +1,225 @@
+"""
+Checks ImageFetcher against a stand-in HTTP server on 127.0.0.1:
+
+- URL restrictions: fetching is off by default, loopback hosts are refused
+  unless private addresses are allowed, the host allowlist is applied to
+  every redirect hop, and redirect loops fail.
+- Size cap: images over `max_bytes` fail, with or without Content-Length.
+- Cache: repeated fetches are served from memory until `max-age` (or the
+  fetcher's `ttl`) runs out, then revalidated with `If-None-Match` or
+  `If-Modified-Since`. Entries without validators are downloaded again.
+  `no-store` responses are not kept. Concurrent fetches of one URL share a
+  download. The least recently used entries are evicted once the cache is
+  over `cache_bytes`.
+
+    python -m scripts.check_image_fetch
+
+Run it from the repository root. It exits with status 1 if any check fails.
+"""
+import asyncio
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from app.core.image_fetch import ImageFetcher, ImageFetchError
+
+LAST_MODIFIED = "Wed, 21 Oct 2015 07:28:00 GMT"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    `/res/<name>?size=&etag=1&last_modified=1&max_age=&delay=&no_store=1&chunked=1`
+    serves `size` bytes with the requested caching headers, answering a
+    matching conditional request with 304. `/to?<url>` redirects to `<url>`.
+    Requests are counted per path in `server.hits`, and 304s in
+    `server.not_modified`.
+    """
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/to":
+            self.send_response(302)
+            self.send_header("Location", url.query)
+            self.end_headers()
+            return
+        if not url.path.startswith("/res/"):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.server.hits[url.path] += 1
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        time.sleep(float(query.get("delay", 0)))
+        etag = f'"{url.path}"' if query.get("etag") else None
+        last_modified = LAST_MODIFIED if query.get("last_modified") else None
+        if (etag and self.headers.get("If-None-Match") == etag) or \
+                (last_modified and self.headers.get("If-Modified-Since") == last_modified):
+            self.server.not_modified[url.path] += 1
+            self.send_response(304)
+            self._cache_headers(query, etag, last_modified)
+            self.end_headers()
+            return
+
+        body = url.path.encode().ljust(int(query.get("size", 64)), b".")
+        self.send_response(200)
+        self._cache_headers(query, etag, last_modified)
+        if not query.get("chunked"):
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        # Without Content-Length, HTTP/1.0 ends the body by closing the connection
+        self.wfile.write(body)
+
+    def _cache_headers(self, query, etag, last_modified):
+        if etag:
+            self.send_header("ETag", etag)
+        if last_modified:
+            self.send_header("Last-Modified", last_modified)
+        if "max_age" in query:
+            self.send_header("Cache-Control", f"max-age={query['max_age']}")
+        if query.get("no_store"):
+            self.send_header("Cache-Control", "no-store")
+
+    def log_message(self, format, *args):
+        pass
+
+
+async def fails(fetcher, url, message):
+    try:
+        await fetcher.fetch(url)
+    except ImageFetchError as e:
+        return message in str(e), str(e)
+    return False, "fetched"
+
+
+async def url_checks(base):
+    loopback = base.replace("localhost", "127.0.0.1")
+    public = ImageFetcher(enabled=True)
+    private = ImageFetcher(enabled=True, allow_private=True, allowed_hosts=["localhost"])
+    redirect_loop = f"{base}/res/a"
+    for _ in range(private.max_redirects + 1):
+        redirect_loop = f"{base}/to?{redirect_loop}"
+    results = {
+        "disabled by default": await fails(ImageFetcher(), f"{base}/res/a", "disabled"),
+        "loopback refused": await fails(public, f"{loopback}/res/a", "non-public address"),
+        "localhost refused": await fails(public, f"{base}/res/a", "non-public address"),
+        "host not in allowlist": await fails(private, f"{loopback}/res/a", "not allowed"),
+        "redirect hop checked": await fails(private, f"{base}/to?{loopback}/res/a", "not allowed"),
+        "redirect loop": await fails(private, redirect_loop, "Too many redirects"),
+    }
+    data = await private.fetch(f"{base}/to?{base}/res/redirected")
+    results["redirect followed"] = (data.startswith(b"/res/redirected"), f"{len(data)} bytes")
+    for fetcher in (public, private):
+        await fetcher.aclose()
+    return results
+
+
+async def size_checks(base):
+    fetcher = ImageFetcher(enabled=True, allow_private=True, max_bytes=1024)
+    results = {
+        "over max_bytes by Content-Length": await fails(fetcher, f"{base}/res/big?size=4096", "larger than"),
+        "over max_bytes while streaming": await fails(
+            fetcher, f"{base}/res/big-chunked?size=4096&chunked=1", "larger than"),
+    }
+    data = await fetcher.fetch(f"{base}/res/small?size=1024")
+    results["at max_bytes"] = (len(data) == 1024, f"{len(data)} bytes")
+    await fetcher.aclose()
+    return results
+
+
+async def cache_checks(base, server):
+    results = {}
+    fetcher = ImageFetcher(enabled=True, allow_private=True, ttl=300)
+
+    url = f"{base}/res/etag?etag=1&max_age=1"
+    first = await fetcher.fetch(url)
+    second = await fetcher.fetch(url)
+    results["fresh entry served from cache"] = (
+        first == second and server.hits["/res/etag"] == 1 and fetcher.hits == 1,
+        f"server requests {server.hits['/res/etag']}, cache hits {fetcher.hits}")
+    await asyncio.sleep(1.1)
+    third = await fetcher.fetch(url)
+    results["stale after max-age, revalidated with ETag"] = (
+        third == first and server.not_modified["/res/etag"] == 1 and fetcher.revalidated == 1,
+        f"server requests {server.hits['/res/etag']}, 304s {server.not_modified['/res/etag']}")
+    await fetcher.fetch(url)
+    results["revalidated entry fresh again"] = (
+        server.hits["/res/etag"] == 2, f"server requests {server.hits['/res/etag']}")
+    await fetcher.aclose()
+
+    # ttl=0: entries without max-age are stale at once
+    fetcher = ImageFetcher(enabled=True, allow_private=True, ttl=0)
+    url = f"{base}/res/last-modified?last_modified=1"
+    await fetcher.fetch(url)
+    await fetcher.fetch(url)
+    results["stale after ttl, revalidated with Last-Modified"] = (
+        server.not_modified["/res/last-modified"] == 1 and fetcher.revalidated == 1,
+        f"server requests {server.hits['/res/last-modified']}, "
+        f"304s {server.not_modified['/res/last-modified']}")
+    url = f"{base}/res/plain"
+    await fetcher.fetch(url)
+    await fetcher.fetch(url)
+    results["stale without validators, downloaded again"] = (
+        server.hits["/res/plain"] == 2 and server.not_modified["/res/plain"] == 0,
+        f"server requests {server.hits['/res/plain']}")
+    await fetcher.aclose()
+
+    fetcher = ImageFetcher(enabled=True, allow_private=True)
+    url = f"{base}/res/no-store?no_store=1"
+    await fetcher.fetch(url)
+    await fetcher.fetch(url)
+    results["no-store not cached"] = (
+        server.hits["/res/no-store"] == 2 and fetcher.stats()["entries"] == 0,
+        f"server requests {server.hits['/res/no-store']}")
+
+    url = f"{base}/res/slow?delay=0.3"
+    first, second = await asyncio.gather(fetcher.fetch(url), fetcher.fetch(url))
+    results["concurrent fetches share one download"] = (
+        first == second and server.hits["/res/slow"] == 1, f"server requests {server.hits['/res/slow']}")
+    await fetcher.aclose()
+
+    fetcher = ImageFetcher(enabled=True, allow_private=True, cache_bytes=250)
+    a, b, c = (f"{base}/res/lru-{name}?size=100" for name in "abc")
+    await fetcher.fetch(a)
+    await fetcher.fetch(b)
+    await fetcher.fetch(a)
+    await fetcher.fetch(c)
+    stats = fetcher.stats()
+    kept = stats["entries"] == 2 and stats["bytes"] == 200
+    await fetcher.fetch(a)
+    await fetcher.fetch(b)
+    results["least recently used evicted over cache_bytes"] = (
+        kept and server.hits["/res/lru-a"] == 1 and server.hits["/res/lru-b"] == 2,
+        f"entries {stats['entries']}, bytes {stats['bytes']}, "
+        f"requests a={server.hits['/res/lru-a']} b={server.hits['/res/lru-b']}")
+    await fetcher.aclose()
+    return results
+
+
+async def run_checks(server):
+    base = f"http://localhost:{server.server_address[1]}"
+    results = await url_checks(base)
+    results.update(await size_checks(base))
+    results.update(await cache_checks(base, server))
+    return results
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.hits = Counter()
+    server.not_modified = Counter()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        results = asyncio.run(run_checks(server))
+    finally:
+        server.shutdown()
+    for name, (passed, detail) in results.items():
+        print(f"{'ok  ' if passed else 'FAIL'} {name}: {detail}")
+    return 0 if all(passed for passed, _ in results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())